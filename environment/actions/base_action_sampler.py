@@ -17,12 +17,18 @@ class BaseActionSampler:
     def sample(self):
         return NotImplemented
 
+    def sample_batch(self, shape):  # (*shape, num_actions) array of independent samples
+        return np.array([self.sample() for _ in range(int(np.prod(shape)))]).reshape(*shape, -1)
+
     def sample_logits(self):
         return NotImplemented
 
     def convert_logits_to_action(self, logits):
         return NotImplemented
 
+    def convert_logits_to_actions(self, logits):
+        return NotImplemented
+
     def brownian_sample(self, previous_action):
         return NotImplemented
 
@@ -15,6 +15,15 @@ class CarRacingActionSampler(BaseActionSampler):
     def sample(self):  # Sampling: [ steer, gas, brake ] = [ [-1, +1] , [0, 1], [0, 1] ]
         return self._continous_sample() if not self.is_discretize_sampling else self.discrete_sample()
 
+    def sample_batch(self, shape):  # Same distributions as sample, drawn for a whole (*shape) batch at once
+        if self.is_discretize_sampling:
+            steer = np.random.choice([round(e, 1) for e in np.arange(start=-1.0, stop=1.0, step=0.1)], size=shape)
+            speed = np.random.choice([round(e, 1) for e in np.arange(start=-1.0, stop=1.0, step=0.2)], size=shape)
+        else:
+            steer = np.random.uniform(low=-1, high=1, size=shape)
+            speed = np.random.uniform(self.max_brake, self.max_gas, size=shape)
+        return np.stack([steer, np.maximum(speed, 0), np.maximum(-speed, 0)], axis=-1)
+
     def sample_logits(self):
         return [torch.randn(1, requires_grad=True),
                 torch.randn(1, requires_grad=True),
@@ -30,6 +39,10 @@ class CarRacingActionSampler(BaseActionSampler):
         action[2] = brake
         return action
 
+    def convert_logits_to_actions(self, logits):  # Branch-free batched mapping: (..., 3) logits -> (..., 3) actions, brake logit is unused
+        speed = torch.tanh(logits[..., 1])
+        return torch.stack([torch.tanh(logits[..., 0]), torch.relu(speed), torch.relu(-speed)], dim=-1)
+
     def _continous_sample(self):
         steer = np.random.uniform(low=-1, high=1)
         speed = random.uniform(self.max_brake, self.max_gas)
@@ -6,10 +6,14 @@
 
 import matplotlib
 import matplotlib.pyplot as plt
+import math
 import numpy as np
 import torch
 import random
 import environment.actions.action_sampler_factory as action_sampler
+from mdrnn.mdrnn import get_mdrnn_cell, forward_mdrnn_cell
+from mdrnn.mdrnn_quantization import is_quantized
+from utility.inference_server import get_inference_client
 from torch.distributions.categorical import Categorical
 matplotlib.use('Qt5Agg')  # Required for Python, Matplotlib 3 on Mac OSX
 
@@ -18,24 +22,35 @@ class SimulatedEnvironment:
     def __init__(self, config, vae, mdrnn):
         self.config = config
         self.mdrnn = mdrnn.cpu()
+        if config['simulated_environment']['is_quantized_mdrnn'] and not is_quantized(mdrnn):
+            raise Exception('is_quantized_mdrnn is set but the MDRNN is float - quantize it once with get_planning_mdrnn before building environments')
+        if config['simulated_environment']['is_quantized_mdrnn'] and config['simulated_environment']['is_mdrnn_cell']:
+            raise Exception('The MDRNN cell shares float LSTM weights and cannot be combined with the quantized MDRNN')
         self.vae = vae.cpu()
+        self.mdrnn_cell = get_mdrnn_cell(self.mdrnn, config['simulated_environment']['is_torchscript_mdrnn_cell']) \
+                          if config['simulated_environment']['is_mdrnn_cell'] else None
+        self.inference_client = get_inference_client()  # Set in worker processes of an inference server
         self.action_sampler = action_sampler.get_action_sampler(config)
         self.temperature = config['simulated_environment']['temperature']
+        self.transition_mode = config['simulated_environment']['transition_mode']
+        if self.transition_mode not in ['sample', 'argmax_mixture_mean', 'expected_mean']:
+            raise Exception(f'Invalid transition mode: {self.transition_mode} - available modes: sample, argmax_mixture_mean, expected_mean')
+
+        # rendering
+        self.monitor = None
+        self.figure_num = random.randint(0, 999)
+        self._reconstruction = None  # Decoded lazily from the latent it was decoded from
+        self._reconstructed_latent_z = None
 
         # mdrnn states
         self.current_latent_state_z = None
         self.current_hidden_states = None
         self._reset_states()
 
-        # rendering
-        self.monitor = None
-        self.figure_num = random.randint(0, 999)
-        self.current_reconstruction = None
-
-    def step(self, action, hidden_state_h=None, latent_state_z=None, is_simulation_real_environment=True, is_reward_tensor=False):
+    def step(self, action, hidden_state_h=None, latent_state_z=None, is_simulation_real_environment=True, is_reward_tensor=False, noise=None):
         hidden_state_h = self.current_hidden_states if hidden_state_h is None else hidden_state_h
         latent_state_z = self.current_latent_state_z if latent_state_z is None else latent_state_z
-        next_latent_state_z, rewards, dones, next_hidden_states = self._step_mdrnn(action, latent_state_z, hidden_state_h)
+        next_latent_state_z, rewards, dones, next_hidden_states = self._step_mdrnn(action, latent_state_z, hidden_state_h, noise)
 
         if is_simulation_real_environment:  # Keep track of latent and hidden states if hallucination is real environment
             self._track_states(next_latent_state_z, next_hidden_states)
@@ -44,40 +59,112 @@ class SimulatedEnvironment:
         r = r if is_reward_tensor else r.item()
         return next_z, r, d, next_h
 
+    def step_batch(self, actions, hidden_states_h, latent_states_z, noise=None):  # B states -> B next latents, rewards and dones as tensors
+        actions = actions if type(actions) == torch.Tensor else torch.tensor(actions, dtype=torch.float32)
+        next_latent_states_z, rewards, dones, next_hidden_states = self._step_mdrnn_batch(actions, latent_states_z, hidden_states_h, noise)
+        return next_latent_states_z, rewards, dones, next_hidden_states
+
+    def step_batch_differentiable(self, actions, hidden_states_h, latent_states_z, noise, mixture_relaxation='gumbel_softmax', gumbel_temperature=1.0):
+        # Reparameterized transition for gradient planning: relaxed mixture weights and pre-drawn noise instead of a hard sample
+        means, standard_deviations, log_mixture_weights, rewards, dones, next_hidden_states = self._forward_mdrnn(actions.unsqueeze(0), latent_states_z.unsqueeze(0), hidden_states_h)
+        means, standard_deviations, log_mixture_weights = means.squeeze(0), standard_deviations.squeeze(0), log_mixture_weights.squeeze(0)
+        gumbel_noise, gaussian_noise = noise
+        mixture_weights = torch.softmax((log_mixture_weights + gumbel_noise) / gumbel_temperature, dim=-1) \
+                          if mixture_relaxation == 'gumbel_softmax' else log_mixture_weights.exp()  # expected_mean: pi-weighted mixture
+        gaussian_noise = gaussian_noise if self.temperature <= 0 else gaussian_noise * math.sqrt(self.temperature)
+        next_latents_z = (mixture_weights.unsqueeze(-1) * (means + standard_deviations * gaussian_noise.unsqueeze(-2))).sum(dim=-2)
+        return next_latents_z, rewards.squeeze(0), dones.squeeze(0) > 0, list(next_hidden_states)
+
+    def sample_relaxation_noise(self, horizon, batch_size):  # Per step: (gumbel noise (batch_size, num_gaussians), gaussian noise (batch_size, latent_size))
+        uniforms = torch.rand(horizon, batch_size, self.config['mdrnn']['num_gaussians']).clamp(min=1e-10)
+        gumbel_noise = -torch.log((-torch.log(uniforms)).clamp(min=1e-10))
+        gaussian_noise = torch.randn(horizon, batch_size, self.config['latent_size'])
+        return list(zip(gumbel_noise, gaussian_noise))
+
+    def sample_noise(self, horizon):  # Common random numbers: one (mixture uniform, gaussian noise) pair per planning step
+        mixture_uniforms = torch.rand(horizon)
+        gaussian_noise = torch.randn(horizon, self.config['latent_size'])
+        return list(zip(mixture_uniforms, gaussian_noise))
+
+    def get_step_noise(self, noise, step):  # Steps beyond the pre-drawn horizon (e.g. rollouts) sample fresh noise
+        return None if noise is None or step >= len(noise) else noise[step]
+
     def reset(self):
         if self.config['visualization']['is_render_dream']:
             self._reset_monitor()
         return self._reset_states()
 
-    def _step_mdrnn(self, action, latent_z, hidden_states):
+    def _step_mdrnn(self, action, latent_z, hidden_states, noise=None):
         action = action if type(action) == torch.Tensor else torch.tensor(action, dtype=torch.float32)
         action = action.unsqueeze(0).unsqueeze(0)
         latent_z = latent_z.unsqueeze(0)
-        means, standard_deviations, log_mixture_weights, rewards, dones, next_hidden_states = self.mdrnn.forward(action, latent_z, hidden_states)
+        means, standard_deviations, log_mixture_weights, rewards, dones, next_hidden_states = self._forward_mdrnn(action, latent_z, hidden_states)
+        if self.transition_mode != 'sample':
+            return self._deterministic_next_z(means, log_mixture_weights).squeeze(0), rewards, dones, next_hidden_states
         log_mixture_weights = log_mixture_weights.squeeze()
-        next_latent_z = self._sample_next_z(means, standard_deviations, log_mixture_weights)
+        next_latent_z = self._sample_next_z(means, standard_deviations, log_mixture_weights, noise)
         return next_latent_z, rewards, dones, next_hidden_states
 
-    def _sample_next_z(self, z_means, z_standard_deviations, log_mixture_weights):  # input: (1, 1, 5, 32) --> (seq_len, batch_size, num_gaussians, latent_size)
+    def _step_mdrnn_batch(self, actions, latents_z, hidden_states, noise=None):  # actions: (batch_size, num_actions), latents: (batch_size, latent_size)
+        means, standard_deviations, log_mixture_weights, rewards, dones, next_hidden_states = self._forward_mdrnn(actions.unsqueeze(0), latents_z.unsqueeze(0), hidden_states)
+        next_latents_z = self._sample_next_z_batch(means.squeeze(0), standard_deviations.squeeze(0), log_mixture_weights.squeeze(0), noise) \
+                         if self.transition_mode == 'sample' else self._deterministic_next_z(means.squeeze(0), log_mixture_weights.squeeze(0))
+        return next_latents_z, rewards.squeeze(0), dones.squeeze(0) > 0, list(next_hidden_states)
+
+    def _forward_mdrnn(self, actions, latents_z, hidden_states):  # inputs with a sequence length of 1: (1, batch_size, ...)
+        is_requires_grad = any(tensor.requires_grad for tensor in [actions, latents_z, *hidden_states])
+        if self.inference_client is not None and not is_requires_grad:  # The server runs without autograd, gradient planners step locally
+            return self.inference_client.forward_mdrnn(actions, latents_z, hidden_states)
+        if self.mdrnn_cell is None:
+            return self.mdrnn.forward(actions, latents_z, hidden_states)
+        return forward_mdrnn_cell(self.mdrnn_cell, actions, latents_z, hidden_states)
+
+    def _deterministic_next_z(self, z_means, log_mixture_weights):  # input: (..., num_gaussians, latent_size) --> (..., latent_size), no RNG
+        if self.transition_mode == 'argmax_mixture_mean':
+            mixture_indices = log_mixture_weights.argmax(dim=-1, keepdim=True).unsqueeze(-1)
+            return z_means.gather(-2, mixture_indices.expand(*z_means.shape[:-2], 1, z_means.size(-1))).squeeze(-2)
+        return (log_mixture_weights.exp().unsqueeze(-1) * z_means).sum(dim=-2)  # expected_mean: pi-weighted mean of the mixture
+
+    def _sample_next_z_batch(self, z_means, z_standard_deviations, log_mixture_weights, noise=None):  # input: (batch_size, num_gaussians, latent_size)
+        # Same sampling as _sample_next_z but with one mixture component and noise vector per row
+        mixture_weights = log_mixture_weights.exp() if self.temperature <= 0 else self._adjust_mixture_weights_by_temperature(log_mixture_weights, self.temperature)
+        random_gaussian_mixture_indices = Categorical(mixture_weights).sample() if noise is None else self._select_mixture_index(mixture_weights, noise[0])
+        batch_indices = torch.arange(z_means.size(0))
+        sampled_means = z_means[batch_indices, random_gaussian_mixture_indices]
+        sampled_standard_deviations = z_standard_deviations[batch_indices, random_gaussian_mixture_indices]
+        random_gaussian_noise = torch.randn_like(sampled_means) if noise is None else noise[1].expand_as(sampled_means)
+        random_gaussian_noise = random_gaussian_noise if self.temperature <= 0 else random_gaussian_noise * torch.sqrt(torch.as_tensor(self.temperature))
+        return sampled_means + sampled_standard_deviations * random_gaussian_noise  # (batch_size, latent_size)
+
+    def _sample_next_z(self, z_means, z_standard_deviations, log_mixture_weights, noise=None):  # input: (1, 1, 5, 32) --> (seq_len, batch_size, num_gaussians, latent_size)
         # Inspiration: https://github.com/hardmaru/WorldModelsExperiments/blob/244f79c2aaddd6ef994d155cd36b34b6d907dcfe/carracing/dream_env.py#L70
         log_mixture_weights = log_mixture_weights if self.temperature <= 0 else self._adjust_mixture_weights_by_temperature(log_mixture_weights, self.temperature)
-        random_gaussian_mixture_index = Categorical(log_mixture_weights).sample().item()
+        if noise is None:
+            random_gaussian_mixture_index = Categorical(log_mixture_weights).sample().item()
+        else:
+            mixture_weights = log_mixture_weights.exp() if self.temperature <= 0 else log_mixture_weights
+            random_gaussian_mixture_index = self._select_mixture_index(mixture_weights, noise[0]).item()
         sampled_mean = z_means[:, :, random_gaussian_mixture_index, :]
         sampled_standard_deviation = z_standard_deviations[:, :, random_gaussian_mixture_index, :]
-        random_gaussian_noise = torch.randn_like(z_means[:, :, random_gaussian_mixture_index, :])  #* torch.sqrt(torch.as_tensor(self.temperature))
+        random_gaussian_noise = torch.randn_like(sampled_mean) if noise is None else noise[1].view_as(sampled_mean)  #* torch.sqrt(torch.as_tensor(self.temperature))
         random_gaussian_noise = random_gaussian_noise if self.temperature <= 0 else random_gaussian_noise * torch.sqrt(torch.as_tensor(self.temperature))
 
         next_latent_z = sampled_mean + sampled_standard_deviation * random_gaussian_noise
 
         return next_latent_z.squeeze(0)  # (1, 1, 32) --> (1, 32)
 
+    def _select_mixture_index(self, mixture_weights, uniform):  # Inverse CDF so a pre-drawn uniform maps to a component under any state's weights
+        cumulative_weights = torch.cumsum(mixture_weights, dim=-1)
+        mixture_indices = (cumulative_weights < uniform.unsqueeze(-1)).sum(dim=-1)
+        return torch.clamp(mixture_indices, max=mixture_weights.size(-1) - 1)
+
     def _adjust_mixture_weights_by_temperature(self, log_mixture_weights, temperature):
         # Paper: https://arxiv.org/pdf/1704.03477.pdf
         # Code: https://github.com/tensorflow/magenta/blob/master/magenta/models/sketch_rnn/model.py
         log_mixture_weights /= temperature
-        log_mixture_weights -= log_mixture_weights.max()
+        log_mixture_weights -= log_mixture_weights.max(dim=-1, keepdim=True)[0]  # Row-wise to support batches of weights
         log_mixture_weights = torch.exp(log_mixture_weights)
-        log_mixture_weights /= log_mixture_weights.sum()  # Softmax normalize
+        log_mixture_weights /= log_mixture_weights.sum(dim=-1, keepdim=True)  # Softmax normalize
         return log_mixture_weights
 
     def _decode_latent_z(self, latent_z):
@@ -90,10 +177,17 @@ class SimulatedEnvironment:
             frame = frame.astype(np.uint8)
             return frame
 
+    @property
+    def current_reconstruction(self):  # VAE decoding is only paid for when a frame is actually read
+        if self._reconstructed_latent_z is not self.current_latent_state_z:
+            self._reconstruction = self._decode_latent_z(self.current_latent_state_z)
+            self._reconstructed_latent_z = self.current_latent_state_z
+        return self._reconstruction
+
     def _reset_states(self):
         self.current_latent_state_z = torch.randn(1, self.config['latent_size'])  # Random latent z
         self.current_hidden_states = self.get_hidden_zeros_state()  # LSTM Hidden state reset
-        return self._decode_latent_z(self.current_latent_state_z)
+        return self.current_reconstruction if self.config['visualization']['is_render_dream'] else None
 
     def _reset_monitor(self):
         if not self.monitor:
@@ -105,7 +199,6 @@ class SimulatedEnvironment:
                                       dtype=np.uint8))
 
     def _track_states(self, next_latent_state_z, next_hidden_states):
-        self.current_reconstruction = self._decode_latent_z(next_latent_state_z)
         self.current_hidden_states = next_hidden_states
         self.current_latent_state_z = next_latent_state_z
 
@@ -125,18 +218,24 @@ class SimulatedEnvironment:
         self.monitor.set_data(reconstruction)
         plt.pause(.01)
 
-    def get_hidden_zeros_state(self):
-        return 2 * [torch.zeros(1, self.config['mdrnn']['hidden_units']).unsqueeze(0)]
+    def get_hidden_zeros_state(self, batch_size=1):
+        return 2 * [torch.zeros(batch_size, self.config['mdrnn']['hidden_units']).unsqueeze(0)]
 
     def sample(self):
         return self.action_sampler.sample()
 
+    def sample_batch(self, shape):
+        return self.action_sampler.sample_batch(shape)
+
     def sample_logits(self):
         return self.action_sampler.sample_logits()
 
     def convert_logits_to_action(self, logits):
         return self.action_sampler.convert_logits_to_action(logits)
 
+    def convert_logits_to_actions(self, logits):
+        return self.action_sampler.convert_logits_to_actions(logits)
+
     def discrete_sample(self):
         return self.action_sampler.discrete_sample()
 
@@ -16,9 +16,11 @@ from os.path import exists, join
 from vae.vae import VAE
 from vae.vae_trainer import VaeTrainer
 from mdrnn.mdrnn import MDRNN
+from mdrnn.mdrnn_quantization import get_planning_mdrnn
 from utility.preprocessor import Preprocessor
 from utility.logging.planning_logger import PlanningLogger
 from planning.simulation.mcts_simulation import MCTS as MCTS_simulation
+from planning.simulation.mcts_simulation import ArrayMCTS as ARRAY_MCTS_simulation
 from planning.simulation.rolling_horizon_simulation import RHEA as RHEA_simulation
 from planning.simulation.random_mutation_hill_climbing_simulation import RMHC as RMHC_simulation
 
@@ -44,9 +46,11 @@ def reload_model(file_location):
 
 
 def get_planning_agent():
+    mcts_parameters = dict(config['planning']['monte_carlo_tree_search'])
+    mcts_simulation = ARRAY_MCTS_simulation if mcts_parameters.pop('is_array_tree') else MCTS_simulation
     simulated_agents = {"RHEA": RHEA_simulation(*config['planning']['rolling_horizon'].values()),
                         "RMHC": RMHC_simulation(*config['planning']['random_mutation_hill_climb'].values()),
-                        "MCTS": MCTS_simulation(*config['planning']['monte_carlo_tree_search'].values())}
+                        "MCTS": mcts_simulation(*mcts_parameters.values())}
 
     return simulated_agents[config['planning']['planning_agent']]
 
@@ -135,7 +139,7 @@ if __name__ == '__main__':
             print(f'current experiment {experiment_name} - file: {file}')
             current_iteration = int(get_digit_from_path(file))
             iteration_result = IterationResult(iteration=current_iteration)
-            mdrnn = reload_model(file)
+            mdrnn = get_planning_mdrnn(config, reload_model(file))
 
             session_name = make_session_name(config["experiment_name"], config['planning']['planning_agent'], get_digit_from_path(file), agent)
             tester = get_planning_tester(config, vae, mdrnn, frame_preprocessor, agent)
@@ -18,6 +18,8 @@ from environment.environment_factory import get_environment
 from mdrnn.mdrnn_trainer import MDRNNTrainer as MDRNNTrainer
 from planning.simulated_planning_controller import SimulatedPlanningController
 from planning.agent_factory import get_planning_agent
+from utility.inference_precision import prepare_models_for_inference
+from mdrnn.mdrnn_quantization import get_planning_mdrnn
 colorama_init()
 
 
@@ -62,6 +64,12 @@ class Main:
         self.mdrnn_trainer.reload_model(mdrnn)
         return
 
+    def prepare_models_for_inference(self, vae, mdrnn):
+        if mdrnn is None:
+            return vae, mdrnn
+        vae, mdrnn = prepare_models_for_inference(self.config, vae, mdrnn, self.frame_preprocessor)
+        return vae, get_planning_mdrnn(self.config, mdrnn)
+
     def run_ntbea_tuning(self, vae, mdrnn):
         agent = get_planning_agent(self.config)
         planning_tester = get_planning_tester(self.config, vae, mdrnn, self.frame_preprocessor, agent)
@@ -104,6 +112,7 @@ if __name__ == '__main__':
 
     vae = main.train_or_reload_vae()
     mdrnn = main.train_or_reload_mdrnn()
+    vae, mdrnn = main.prepare_models_for_inference(vae, mdrnn)
 
     if config['test_suite']["is_run_model_tests"]:
         main.run_model_tests(vae, mdrnn)
@@ -22,6 +22,7 @@ from tqdm import tqdm
 from PIL import Image
 from vae.vae import VAE
 from mdrnn.mdrnn import MDRNN
+from mdrnn.mdrnn_quantization import get_planning_mdrnn
 from os.path import join, exists
 from vae.vae_trainer import VaeTrainer
 from gym.envs.box2d.car_dynamics import Car
@@ -30,6 +31,7 @@ from tests_custom.test_suite_factory import get_planning_tester
 from planning.simulation.agent_wrapper import AgentWrapper
 from environment.environment_factory import get_environment
 from utility.logging.planning_logger import PlanningLogger
+from utility.inference_server import InferenceServer, init_inference_client
 from torch.multiprocessing import Pool, Process, Manager, RLock, Lock, Value
 from mdrnn.iteration_stats.iteration_result import IterationResult
 from environment.actions.action_sampler_factory import get_action_sampler
@@ -98,28 +100,37 @@ class IterativeTrainer:
         self.threads = self.num_rollouts if self.num_rollouts < self.threads else self.threads
         self._set_torch_threads(threads=1)  # 1 to ensure underlying threads only uses 1 thread to prevent hidden threading - speed fix when multithreaded rollout generation
 
-        vae, mdrnn = self._get_vae_mdrnn()
-        vae, mdrnn = vae.eval(), mdrnn.eval()
+        vae, mdrnn = self._get_shared_vae_mdrnn()
         num_rollouts_per_thread = int(self.num_rollouts / self.threads)
         print(f'{self.num_rollouts} rollouts across {self.threads} cores with {num_rollouts_per_thread} rollouts each.')
 
         shared_rollout_counter = Value('i', self._rollout_counter,)
-        with Pool(int(self.threads), initargs=(Lock(), RLock(), shared_rollout_counter,), initializer=self.init_globals) as pool:
-            threads = [pool.apply_async(self._get_rollout_batch, args=(num_rollouts_per_thread, thread_id, iteration, vae, mdrnn))
+        # Workers submit MDRNN steps and VAE encodings to one batched model process instead of running their own copies
+        inference_server = InferenceServer(self.config, vae, mdrnn, num_clients=self.threads).start() if self.config['inference_server']['is_inference_server'] else None
+        client_initargs = inference_server.get_initializer()[1] if inference_server else (None, None)
+        with Pool(int(self.threads), initargs=(Lock(), RLock(), shared_rollout_counter, vae, mdrnn, *client_initargs), initializer=self.init_globals) as pool:
+            threads = [pool.apply_async(self._get_rollout_batch, args=(num_rollouts_per_thread, thread_id, iteration))
                        for thread_id in range(1, self.threads + 1)]
             pool.close()
             [thread.get() for thread in threads]
             pool.close()
+        if inference_server:
+            inference_server.stop()
         self._rollout_counter = shared_rollout_counter.value
 
         print(f'Done - {self.num_rollouts} rollouts saved in {self.data_dir}')
 
-    def init_globals(self, _rollout_lock, tqdm_lock, _rollout_counter):
+    def init_globals(self, _rollout_lock, tqdm_lock, _rollout_counter, _vae, _mdrnn, inference_clients=None, inference_client_counter=None):
         global rollout_lock
         global rollout_counter
+        global shared_vae
+        global shared_mdrnn
         rollout_lock = _rollout_lock
         rollout_counter = _rollout_counter
+        shared_vae, shared_mdrnn = _vae, get_planning_mdrnn(self.config, _mdrnn)  # Attached once per worker from shared memory
         tqdm.set_lock(tqdm_lock)
+        if inference_clients is not None:
+            init_inference_client(inference_clients, inference_client_counter)
 
     def _set_rollout_count(self):
         if self.is_replay_buffer:  # To override old files if rollout capacity is full
@@ -130,9 +141,9 @@ class IterativeTrainer:
     def _get_rollout_file_count(self):
         return len([name for root, dirs, files in os.walk(self.data_dir) for name in files])
 
-    def _get_rollout_batch(self, num_rollouts_per_thread, thread_id, iteration, vae, mdrnn):
+    def _get_rollout_batch(self, num_rollouts_per_thread, thread_id, iteration):
         environment = get_environment(self.config)
-        agent_wrapper = AgentWrapper(self.planning_agent, self.config, vae, mdrnn)
+        agent_wrapper = AgentWrapper(self.planning_agent, self.config, shared_vae, shared_mdrnn)
         for rollout_number in range(1, num_rollouts_per_thread + 1):
             actions, states, rewards, terminals = self._create_rollout(agent_wrapper, environment, thread_id, rollout_number, num_rollouts_per_thread, iteration)
 
@@ -169,6 +180,10 @@ class IterativeTrainer:
         mdrnn.cpu()
         return vae, mdrnn
 
+    def _get_shared_vae_mdrnn(self):  # Inference copies in shared memory: spawned workers receive handles instead of pickled weights
+        vae, mdrnn = self._get_vae_mdrnn()
+        return vae.eval().share_memory(), mdrnn.eval().share_memory()
+
     def _set_car_position(self, start_track, environment):
         if start_track == 1:
             return
@@ -209,15 +224,15 @@ class IterativeTrainer:
     def _test_planning(self, iteration, iteration_results, test_threads):
         if len(test_threads) >= self.max_test_threads:  # Prevent spawning too many test threads
             [p.join() for p in test_threads]
-        p = Process(target=self._test_thread, args=[iteration, iteration_results])
+        vae, mdrnn = self._get_shared_vae_mdrnn()  # Loaded once here, the test process and its trial workers attach to the same weights
+        p = Process(target=self._test_thread, args=[iteration, iteration_results, vae, mdrnn])
         p.start()
         test_threads.append(p)
 
-    def _test_thread(self, iteration, iteration_results):
+    def _test_thread(self, iteration, iteration_results, vae, mdrnn):
         print(f'Running test for iteration: {iteration}')
         preprocessor = Preprocessor(self.config['preprocessor'])
-        vae, mdrnn = self._get_vae_mdrnn()
-        tester = get_planning_tester(self.config, vae, mdrnn, preprocessor, self.planning_agent)
+        tester = get_planning_tester(self.config, vae, get_planning_mdrnn(self.config, mdrnn), preprocessor, self.planning_agent)
 
         session_name = self._make_session_name(self.config["experiment_name"], self.config['planning']['planning_agent'], iteration)
         test_name, trials_actions, trials_rewards, trials_elites, trial_max_rewards, trial_seeds = tester.run_specific_test(self.test_scenario, session_name)
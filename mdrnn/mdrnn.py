@@ -62,3 +62,56 @@ class MDRNN(nn.Module):
         dones = mdn_outputs[:, :, -1]
 
         return means, standard_deviations, log_mixture_weights, rewards, dones, (next_hidden_states, next_cell_states)
+
+
+class MDRNNCell(nn.Module):  # Inference-only single step of a trained MDRNN for planning - shares its weights
+    def __init__(self, mdrnn):
+        super(MDRNNCell, self).__init__()
+        self.latent_size = mdrnn.latent_size
+        self.num_gaussians = mdrnn.num_gaussians
+        self.stride = mdrnn.stride
+        lstm = mdrnn.lstm.lstm
+        self.lstm_cell = nn.LSTMCell(input_size=lstm.input_size, hidden_size=lstm.hidden_size)
+        self.lstm_cell.weight_ih, self.lstm_cell.weight_hh = lstm.weight_ih_l0, lstm.weight_hh_l0
+        self.lstm_cell.bias_ih, self.lstm_cell.bias_hh = lstm.bias_ih_l0, lstm.bias_hh_l0
+        self.mdn_output = mdrnn.mdn.linear_gaussian_mixture_model
+        self._slice_mdn_output()
+
+    def _slice_mdn_output(self):  # Row slices of the MDN output layer are precomputed as views of the shared weights
+        weight, bias = self.mdn_output.weight.detach(), self.mdn_output.bias.detach()
+        self.means_weight, self.means_bias = weight[:self.stride], bias[:self.stride]
+        self.log_standard_deviations_weight = weight[self.stride:2 * self.stride]
+        self.log_standard_deviations_bias = bias[self.stride:2 * self.stride]
+        self.mixture_weights_weight = weight[2 * self.stride:2 * self.stride + self.num_gaussians]
+        self.mixture_weights_bias = bias[2 * self.stride:2 * self.stride + self.num_gaussians]
+        self.reward_done_weight, self.reward_done_bias = weight[-2:], bias[-2:]
+
+    def _apply(self, *args, **kwargs):  # Moving or casting the weights replaces them, so the slices are taken again
+        module = super(MDRNNCell, self)._apply(*args, **kwargs)
+        self._slice_mdn_output()
+        return module
+
+    def forward(self, actions: torch.Tensor, latents: torch.Tensor, hidden_state: torch.Tensor, cell_state: torch.Tensor):
+        # (batch, actions), (batch, latent), (batch, hidden) x 2 -> same outputs as MDRNN.forward without the sequence dimension
+        dtype = self.means_weight.dtype  # float32 in and out even when the shared weights are reduced precision
+        actions, latents, hidden_state, cell_state = actions.to(dtype), latents.to(dtype), hidden_state.to(dtype), cell_state.to(dtype)
+        next_hidden_state, next_cell_state = self.lstm_cell(torch.cat([actions, latents], dim=-1), (hidden_state, cell_state))
+        means = F.linear(next_hidden_state, self.means_weight, self.means_bias).view(-1, self.num_gaussians, self.latent_size)
+        log_standard_deviations = F.linear(next_hidden_state, self.log_standard_deviations_weight, self.log_standard_deviations_bias)
+        standard_deviations = torch.exp(log_standard_deviations).view(-1, self.num_gaussians, self.latent_size)
+        log_mixture_weights = F.log_softmax(F.linear(next_hidden_state, self.mixture_weights_weight, self.mixture_weights_bias), dim=-1)
+        rewards_dones = F.linear(next_hidden_state, self.reward_done_weight, self.reward_done_bias)
+        return means.float(), standard_deviations.float(), log_mixture_weights.float(), rewards_dones[:, 0].float(), rewards_dones[:, 1].float(), \
+               next_hidden_state.float(), next_cell_state.float()
+
+
+def get_mdrnn_cell(mdrnn, is_torchscript=False):
+    mdrnn_cell = MDRNNCell(mdrnn).eval()
+    return torch.jit.script(mdrnn_cell) if is_torchscript else mdrnn_cell
+
+
+def forward_mdrnn_cell(mdrnn_cell, actions, latents, hidden_states):  # Same inputs and outputs as MDRNN.forward with a sequence length of 1
+    means, standard_deviations, log_mixture_weights, rewards, dones, next_hidden_state, next_cell_state = \
+        mdrnn_cell(actions[0], latents[0], hidden_states[0][0], hidden_states[1][0])
+    return means.unsqueeze(0), standard_deviations.unsqueeze(0), log_mixture_weights.unsqueeze(0), rewards.unsqueeze(0), dones.unsqueeze(0), \
+           (next_hidden_state.unsqueeze(0), next_cell_state.unsqueeze(0))
@@ -0,0 +1,125 @@
+""" Dynamic int8 quantization of a trained MDRNN for planning """
+#  Copyright (c) 2020, - All Rights Reserved
+#  This file is part of the Evolutionary Planning on a Learned World Model thesis.
+#  Unauthorized copying of this file, via any medium is strictly prohibited without the consensus of the authors.
+#  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
+
+import copy
+import json
+import time
+import pickle
+import torch
+import numpy as np
+import torch.nn as nn
+from mdrnn.mdrnn import MDRNN
+from utility.inference_precision import load_held_out_rollout
+
+
+class QuantizedMDRNN(MDRNN):  # Packed int8 weights cannot be rebuilt from shared memory, so other processes receive them by value
+    def __reduce__(self):
+        return _rebuild_quantized_mdrnn, (pickle.dumps(self.__dict__),)
+
+
+def _rebuild_quantized_mdrnn(state):
+    mdrnn = QuantizedMDRNN.__new__(QuantizedMDRNN)
+    mdrnn.__setstate__(pickle.loads(state))
+    return mdrnn
+
+
+def quantize_mdrnn(mdrnn):  # int8 LSTM and MDN weights, activations stay float - the float model itself is left untouched
+    quantized_mdrnn = torch.quantization.quantize_dynamic(copy.deepcopy(mdrnn).cpu().eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    quantized_mdrnn.__class__ = QuantizedMDRNN
+    return quantized_mdrnn
+
+
+def is_quantized(mdrnn):
+    return not any(isinstance(module, (nn.LSTM, nn.Linear)) for module in mdrnn.modules())
+
+
+def get_planning_mdrnn(config, mdrnn):  # Quantized once per process, every simulated environment then shares the int8 model
+    is_quantized_mdrnn = config['simulated_environment']['is_quantized_mdrnn']
+    return quantize_mdrnn(mdrnn) if is_quantized_mdrnn and not is_quantized(mdrnn) else mdrnn
+
+
+def load_quantized_mdrnn(config, frame_preprocessor, num_actions):  # Quantization is deterministic, so the float checkpoint is the only artifact
+    from mdrnn.mdrnn_trainer import MDRNNTrainer
+    mdrnn = MDRNN(num_actions=num_actions, latent_size=config['latent_size'],
+                  num_gaussians=config['mdrnn']['num_gaussians'], num_hidden_units=config['mdrnn']['hidden_units'])
+    mdrnn = MDRNNTrainer(config, frame_preprocessor).reload_model(mdrnn, device='cpu').eval()
+    return mdrnn, quantize_mdrnn(mdrnn)
+
+
+def report_quantized_mdrnn(config, vae, mdrnn, quantized_mdrnn, preprocessor, num_plans=20, horizon=20, num_start_states=10, latency_steps=500):
+    # Per-step latency and how often both models rank candidate plans alike from held-out start states
+    from environment.simulated_environment import SimulatedEnvironment
+    config = copy.deepcopy(config)
+    config['simulated_environment'].update(transition_mode='expected_mean', is_mdrnn_cell=False, is_quantized_mdrnn=False)
+    environments = {'float': SimulatedEnvironment(config, vae, mdrnn), 'int8': SimulatedEnvironment(config, vae, quantized_mdrnn)}
+
+    observations, actions = load_held_out_rollout(config)
+    with torch.no_grad():
+        latents, _ = vae.encoder(preprocessor.preprocess_frames(observations))
+        actions = torch.as_tensor(actions, dtype=torch.float32)
+        start_steps = np.linspace(0, len(latents) - 1, num_start_states).astype(int)
+        hidden_states = _get_teacher_forced_hidden_states(mdrnn, latents, actions)
+
+        latencies = {name: _measure_step_latency(environment, latents[0:1], hidden_states[0], actions[0], latency_steps)
+                     for name, environment in environments.items()}
+        rank_correlations, top_plan_agreements = [], []
+        for step in start_steps:
+            plans = [[environments['float'].sample() for _ in range(horizon)] for _ in range(num_plans)]
+            fitness = {name: [_evaluate_plan(environment, plan, latents[step:step + 1], hidden_states[step]) for plan in plans]
+                       for name, environment in environments.items()}
+            rank_correlations.append(_spearman_rank_correlation(fitness['float'], fitness['int8']))
+            top_plan_agreements.append(np.argmax(fitness['float']) == np.argmax(fitness['int8']))
+
+    print(f'MDRNN step latency - float: {latencies["float"] * 1000:.3f} ms | int8: {latencies["int8"] * 1000:.3f} ms | '
+          f'speedup: {latencies["float"] / latencies["int8"]:.2f}x')
+    print(f'Fitness ranking agreement over {len(start_steps)} start states x {num_plans} plans - '
+          f'spearman: {np.mean(rank_correlations):.3f} | same best plan: {np.mean(top_plan_agreements) * 100:.1f}%')
+    return latencies, np.mean(rank_correlations), np.mean(top_plan_agreements)
+
+
+def _get_teacher_forced_hidden_states(mdrnn, latents, actions):  # hidden_states[t] is the state before step t
+    hidden = [torch.zeros(1, 1, mdrnn.lstm.lstm.hidden_size) for _ in range(2)]
+    hidden_states = [hidden]
+    for latent, action in zip(latents, actions):
+        *_, hidden = mdrnn(action.view(1, 1, -1), latent.view(1, 1, -1), hidden)
+        hidden_states.append(list(hidden))
+    return hidden_states
+
+
+def _measure_step_latency(environment, latent, hidden, action, steps):
+    start_time = time.perf_counter()
+    for _ in range(steps):
+        environment.step(action, hidden, latent, is_simulation_real_environment=False)
+    return (time.perf_counter() - start_time) / steps
+
+
+def _evaluate_plan(environment, plan, latent, hidden):
+    total_reward = 0
+    for action in plan:
+        latent, reward, is_done, hidden = environment.step(action, hidden, latent, is_simulation_real_environment=False)
+        total_reward += reward
+        if is_done:
+            break
+    return total_reward
+
+
+def _spearman_rank_correlation(a, b):
+    ranks_a, ranks_b = np.argsort(np.argsort(a)), np.argsort(np.argsort(b))
+    return np.corrcoef(ranks_a, ranks_b)[0, 1]
+
+
+if __name__ == '__main__':  # Quantizes the best MDRNN checkpoint of the configured experiment and reports it against the float model
+    from vae.vae import VAE
+    from vae.vae_trainer import VaeTrainer
+    from utility.preprocessor import Preprocessor
+    from environment.actions.action_sampler_factory import get_action_sampler
+
+    with open('config.json') as config_file:
+        config = json.load(config_file)
+    frame_preprocessor = Preprocessor(config['preprocessor'])
+    vae = VaeTrainer(config, frame_preprocessor).reload_model(VAE(config), device='cpu').eval()
+    mdrnn, quantized_mdrnn = load_quantized_mdrnn(config, frame_preprocessor, get_action_sampler(config).num_actions)
+    report_quantized_mdrnn(config, vae, mdrnn, quantized_mdrnn, frame_preprocessor)
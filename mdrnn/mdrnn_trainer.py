@@ -24,6 +24,7 @@ from torch.utils.data import DataLoader
 from mdrnn.learning import EarlyStopping
 from utility.logging.model_training_logger import ModelTrainingLogger
 from utility.rollout_handling.mdrnn_loaders import RolloutSequenceDataset
+from utility.rollout_handling.latent_encoder import encode_rollouts
 
 
 def transform(frames):
@@ -96,6 +97,7 @@ class MDRNNTrainer:
         self.N_train_batch_until_test_batch = self.config['mdrnn_trainer']['N_train_batch_until_test_batch']
         self.N_train_batch_until_pred_sampling = self.config['mdrnn_trainer']['N_train_batch_until_pred_sampling']
         self.is_random_sampling = self.config['mdrnn_trainer']['is_random_sampling']
+        self.is_precomputed_latents = self.config['mdrnn_trainer']['is_precomputed_latents']
 
         self.baseline_test_loss, self.baseline_train_loss = 0, 0
 
@@ -216,7 +218,14 @@ class MDRNNTrainer:
             print(f'New best model found and saved')
 
     def _load_data(self, max_size=0, is_random_sampling=False):  # To avoid loading data when not training
-        test_dataset = self._create_dataset(data_location=self.test_data_dir if self.is_use_specific_test_data else self.data_dir,
+        test_data_dir = self.test_data_dir if self.is_use_specific_test_data else self.data_dir
+        train_data_dir = self.data_dir
+        if self.is_precomputed_latents:  # Frozen VAE: encode each rollout once instead of on every batch
+            self.vae.eval()
+            test_data_dir = encode_rollouts(self.vae, transform, self.config, test_data_dir, self.device)
+            train_data_dir = encode_rollouts(self.vae, transform, self.config, train_data_dir, self.device)
+
+        test_dataset = self._create_dataset(data_location=test_data_dir,
                                             buffer_size=self.config['mdrnn_trainer']['test_buffer_size'],
                                             file_ratio=self.config['mdrnn_trainer']['train_test_files_ratio'],
                                             is_train=False,
@@ -229,7 +238,7 @@ class MDRNNTrainer:
                                       batch_size=self.config['mdrnn_trainer']['batch_size'],
                                       num_workers=self.num_workers, shuffle=False, drop_last=True)
 
-        train_dataset = self._create_dataset(data_location=self.data_dir,
+        train_dataset = self._create_dataset(data_location=train_data_dir,
                                              buffer_size=self.config['mdrnn_trainer']['train_buffer_size'],
                                              file_ratio=self.config['mdrnn_trainer']['train_test_files_ratio'],
                                              is_train=True,
@@ -238,9 +247,10 @@ class MDRNNTrainer:
                                              is_random_sampling=is_random_sampling
                                              )
 
+        train_sampler = train_dataset.get_window_sampler()
         self.train_loader = DataLoader(dataset=train_dataset,
                                        batch_size=self.config['mdrnn_trainer']['batch_size'],
-                                       num_workers=self.num_workers, shuffle=True, drop_last=True)
+                                       num_workers=self.num_workers, shuffle=train_sampler is None, sampler=train_sampler, drop_last=True)
 
     def _get_scheduler(self, optimizer):
         return ReduceLROnPlateau(optimizer,
@@ -267,7 +277,9 @@ class MDRNNTrainer:
                                       is_same_testdata=is_same_testdata,
                                       buffer_size=buffer_size,
                                       file_ratio=file_ratio,
-                                      max_size=max_size, is_random_sampling=is_random_sampling)
+                                      max_size=max_size, is_random_sampling=is_random_sampling,
+                                      is_precomputed_latents=self.is_precomputed_latents,
+                                      window_stride=self.config['mdrnn_trainer']['window_stride'])
         if len(dataset._files) == 0:
             raise Exception(f'No files found in {data_location}')
         return dataset
@@ -425,6 +437,8 @@ class MDRNNTrainer:
 
     def _extract_batch_data(self, batch):
         obs, actions, rewards, terminals, next_obs = [arr.to(self.device) for arr in batch]
+        if self.is_precomputed_latents:  # Loader already provides (batch, seq, latent) samples
+            return obs, actions, rewards, terminals, next_obs
         latent_obs, latent_next_obs = self._to_latent(obs, next_obs)
         return latent_obs, actions, rewards, terminals, latent_next_obs
 
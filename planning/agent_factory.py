@@ -1,4 +1,5 @@
 from planning.simulation.mcts_simulation import MCTS as MCTS_simulation
+from planning.simulation.mcts_simulation import ArrayMCTS as ARRAY_MCTS_simulation
 from planning.simulation.rolling_horizon_simulation import RHEA as RHEA_simulation
 from planning.simulation.random_mutation_hill_climbing_simulation import RMHC as RMHC_simulation
 from planning.simulation.random_simulation import RandomAgent as RANDOM_simulation
@@ -12,9 +13,11 @@ def get_planning_agent(config):
 
 
 def _get_planning_agent(agent, config):
+    mcts_parameters = dict(config['planning']['monte_carlo_tree_search'])
+    mcts_simulation = ARRAY_MCTS_simulation if mcts_parameters.pop('is_array_tree') else MCTS_simulation
     simulated_agents = {"RHEA": RHEA_simulation(*config['planning']['rolling_horizon'].values()),
                         "RMHC": RMHC_simulation(*config['planning']['random_mutation_hill_climb'].values()),
-                        "MCTS": MCTS_simulation(*config['planning']['monte_carlo_tree_search'].values()),
+                        "MCTS": mcts_simulation(*mcts_parameters.values()),
                         "SGDHC": SGDHC_simulation(*config['planning']['gradient_hill_climb'].values()),
                         "RANDOM": RANDOM_simulation()
                         }
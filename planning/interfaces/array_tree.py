@@ -0,0 +1,99 @@
+""" Struct-of-arrays tree representation for MCTS """
+#  Copyright (c) 2020, - All Rights Reserved
+#  This file is part of the Evolutionary Planning on a Learned World Model thesis.
+#  Unauthorized copying of this file, via any medium is strictly prohibited without the consensus of the authors.
+#  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
+
+import numpy as np
+
+
+class ArrayTree:  # Node i is row i of every array and actions are referenced by index into one shared action table
+    def __init__(self, actions, capacity=1024):
+        self.actions = np.asarray(actions, dtype=np.float64)  # (num_actions, action_size)
+        self.num_actions = len(self.actions)
+        self.size = 0  # Rows in use, including the child rows reserved by expanded nodes
+        self.visit_counts = np.zeros(capacity, dtype=np.int64)  # N(s,a)
+        self.total_rewards = np.zeros(capacity, dtype=np.float64)
+        self.parents = np.full(capacity, -1, dtype=np.int64)
+        self.action_indices = np.full(capacity, -1, dtype=np.int64)
+        self.num_children = np.zeros(capacity, dtype=np.int64)
+        self.first_children = np.full(capacity, -1, dtype=np.int64)  # Children are contiguous rows from here, -1 if unexpanded
+
+    def add_node(self, parent=-1, action_index=-1):
+        if parent < 0:
+            node = self._allocate(1)
+        else:
+            if self.first_children[parent] < 0:  # Every child of a node gets a row of one block reserved at its first expansion
+                self.first_children[parent] = self._allocate(self.num_actions)
+            node = self.first_children[parent] + self.num_children[parent]
+            self.num_children[parent] += 1
+        self.parents[node], self.action_indices[node] = parent, action_index
+        return node
+
+    def _allocate(self, num_rows):
+        if self.size + num_rows > len(self.visit_counts):
+            self._grow(max(2 * len(self.visit_counts), self.size + num_rows))
+        rows = slice(self.size, self.size + num_rows)
+        self.visit_counts[rows], self.total_rewards[rows], self.num_children[rows] = 0, 0, 0
+        self.parents[rows], self.action_indices[rows], self.first_children[rows] = -1, -1, -1
+        self.size += num_rows
+        return rows.start
+
+    def get_children(self, node):
+        return np.arange(self.first_children[node], self.first_children[node] + self.num_children[node])
+
+    def get_action(self, node):
+        return self.actions[self.action_indices[node]]
+
+    def is_fully_expanded(self, node):
+        return self.num_children[node] >= self.num_actions
+
+    def get_untried_action_indices(self, node):
+        return np.setdiff1d(np.arange(self.num_actions), self.action_indices[self.get_children(node)])
+
+    def get_path(self, node):  # Node and all of its ancestors
+        path = []
+        while node >= 0:
+            path.append(node)
+            node = self.parents[node]
+        return np.array(path, dtype=np.int64)
+
+    def select_uct_child(self, node, temperature):  # Vectorized Upper Confidence Bound for Trees over all children
+        children = self.get_children(node)
+        visit_counts = self.visit_counts[children]
+        exploit_average_rewards = self.total_rewards[children] / visit_counts  # Q(s,a)
+        exploration = np.sqrt(np.log(self.visit_counts[node]) / visit_counts)
+        return children[np.argmax(exploit_average_rewards + temperature * exploration)]
+
+    def reroot(self, node):  # Keep only the subtree of node (compacted to the front with node as 0) and return the new root
+        subtree, frontier = [np.array([node])], np.array([node])
+        block_offsets = np.arange(self.num_actions)
+        while frontier.size > 0:  # Child blocks are copied whole so the children of a node stay contiguous
+            expanded = frontier[self.first_children[frontier] >= 0]
+            blocks = self.first_children[expanded][:, None] + block_offsets
+            subtree.append(blocks.ravel())
+            frontier = blocks[block_offsets < self.num_children[expanded][:, None]]
+        subtree = np.concatenate(subtree)
+
+        new_indices = np.full(len(self.parents), -1, dtype=np.int64)
+        new_indices[subtree] = np.arange(len(subtree))
+        self.visit_counts[:len(subtree)] = self.visit_counts[subtree]
+        self.total_rewards[:len(subtree)] = self.total_rewards[subtree]
+        self.action_indices[:len(subtree)] = self.action_indices[subtree]
+        self.num_children[:len(subtree)] = self.num_children[subtree]
+        parents = self.parents[subtree]
+        self.parents[:len(subtree)] = np.where(parents >= 0, new_indices[parents], -1)
+        self.parents[0] = -1
+        first_children = self.first_children[subtree]
+        self.first_children[:len(subtree)] = np.where(first_children >= 0, new_indices[first_children], -1)
+        self.size = len(subtree)
+        return 0
+
+    def _grow(self, capacity):
+        extra = capacity - len(self.visit_counts)
+        self.visit_counts = np.concatenate([self.visit_counts, np.zeros(extra, dtype=np.int64)])
+        self.total_rewards = np.concatenate([self.total_rewards, np.zeros(extra, dtype=np.float64)])
+        self.parents = np.concatenate([self.parents, np.full(extra, -1, dtype=np.int64)])
+        self.action_indices = np.concatenate([self.action_indices, np.full(extra, -1, dtype=np.int64)])
+        self.num_children = np.concatenate([self.num_children, np.zeros(extra, dtype=np.int64)])
+        self.first_children = np.concatenate([self.first_children, np.full(extra, -1, dtype=np.int64)])
@@ -6,6 +6,8 @@ import numpy as np
 #  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
 
 class Node:
+    __slots__ = ['action', 'parent', 'total_reward', 'visit_count', 'children', 'actions', 'transition']  # Small nodes for large trees
+
     def __init__(self, parent=None, action=None, actions=None):
         self.action = action
         self.parent = parent
@@ -13,6 +15,7 @@ class Node:
         self.visit_count = 0  # N(s,a)
         self.children = []
         self.actions = actions
+        self.transition = None  # Optional cached (latent, reward, is_done, hidden) from taking action in the parent's state
 
     def is_fully_expanded(self):
         return len(self.actions) <= 0
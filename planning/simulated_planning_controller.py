@@ -78,7 +78,7 @@ class SimulatedPlanningController:
             self.action = self._get_action_placeholder()
 
     def _encode_state(self, state):
-        state = self.preprocessor.resize_frame(state).unsqueeze(0)
+        state = self.preprocessor.preprocess_frame(state)
         reconstruction, z_mean, z_log_standard_deviation = self.vae(state)
         latent_state = self.vae.sample_reparametarization(z_mean, z_log_standard_deviation)
         return latent_state, reconstruction
@@ -36,7 +36,10 @@ class AgentWrapper:
 
     def _compress(self, state):
         with torch.no_grad():
-            state = self.preprocessor.resize_frame(state).unsqueeze(0)
-            _, z_mean, z_log_standard_deviation = self.vae(state)
+            state = self.preprocessor.preprocess_frame(state)
+            if self.simulated_environment.inference_client is not None:
+                z_mean, z_log_standard_deviation = self.simulated_environment.inference_client.encode(state)
+            else:
+                _, z_mean, z_log_standard_deviation = self.vae(state)
             latent_state = self.vae.sample_reparametarization(z_mean, z_log_standard_deviation)
             return latent_state
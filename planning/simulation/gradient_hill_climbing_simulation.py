@@ -5,14 +5,30 @@
 #  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
 
 import torch
+import inspect
+from torch.utils.checkpoint import checkpoint
 from planning.interfaces.abstract_grad_hill_climb_simulation import AbstractGradientHillClimbing
 from utility.logging.single_step_logger import SingleStepLogger
 
+IS_NON_REENTRANT_CHECKPOINT = 'use_reentrant' in inspect.signature(checkpoint).parameters  # torch >= 1.11
 
 class SGDHC(AbstractGradientHillClimbing):
-    def __init__(self, horizon, max_steps, is_shift_buffer, learning_rate):
+    def __init__(self, horizon, max_steps, is_shift_buffer, learning_rate, restarts=1, is_differentiable_dream=False,
+                 mixture_relaxation='gumbel_softmax', gumbel_temperature=1.0, truncation_length=0, checkpoint_length=0):
         super().__init__(horizon, max_steps, is_shift_buffer, learning_rate)
-        self.logit_sequence = None
+        self.restarts = restarts
+        self.logits = None  # (restarts, horizon, num_actions), every restart is optimized independently in one batch
+        self.best_logits = None
+
+        # Differentiable dream: relaxed mixture and noise drawn once per search so every gradient step sees the same dream
+        self.is_differentiable_dream = is_differentiable_dream
+        self.mixture_relaxation = mixture_relaxation
+        self.gumbel_temperature = gumbel_temperature
+        self.truncation_length = truncation_length  # Steps between detached recurrent states, 0 backpropagates through the full horizon
+        self.checkpoint_length = checkpoint_length  # Steps per recomputed segment of the unroll, 0 keeps all activations
+        self.noise = None
+        if mixture_relaxation not in ['gumbel_softmax', 'expected_mean']:
+            raise Exception(f'Invalid mixture relaxation: {mixture_relaxation} - available relaxations: gumbel_softmax, expected_mean')
         self.latent = None
         self.hidden = None
         self.optimizer = None
@@ -20,52 +36,107 @@ class SGDHC(AbstractGradientHillClimbing):
     def search(self, environment, latent, hidden):
         self.latent = latent
         self.hidden = hidden
-        self.logit_sequence = self._initialize_sequence(environment)
-
-        self.optimizer = torch.optim.Adam(self.logit_sequence, lr=self.learning_rate)
+        self.logits = self._initialize_logits(environment)
+        self.noise = environment.sample_relaxation_noise(self.horizon, self.restarts) if self.is_differentiable_dream else None
+        self.optimizer = torch.optim.Adam([self.logits], lr=self.learning_rate)
+        best_reward, best_logits = None, None
+        frozen_parameters = self._freeze_model_parameters(environment) if self._is_reentrant_checkpoint() else []
 
         for step in range(self.max_steps):
-            plan = [environment.convert_logits_to_action(logit) for logit in self.logit_sequence]
-            total_reward = self._evaluate_plan(plan, environment)
-            self._gradient_step(total_reward)
+            total_rewards = self._evaluate_plans(environment.convert_logits_to_actions(self.logits), environment)
+            best_restart = total_rewards.argmax()
+            if best_reward is None or total_rewards[best_restart] > best_reward:  # Best plan that was actually evaluated
+                best_reward, best_logits = total_rewards[best_restart].item(), self.logits[best_restart].detach().clone()
+            self._gradient_step(total_rewards)
 
-        best_action = self._convert_action_to_value(environment.convert_logits_to_action(self.logit_sequence[0]))
+        for parameter in frozen_parameters:
+            parameter.requires_grad_(True)
+        self.best_logits = best_logits
+        best_action = environment.convert_logits_to_actions(best_logits[0]).tolist()
         return best_action, None
 
+    def _initialize_logits(self, environment):
+        num_actions = environment.action_sampler.num_actions
+        if self.is_shift_buffer and self.logits is not None and self.logits.shape == (self.restarts, self.horizon, num_actions):
+            logits = self._shift_buffer(self.logits.detach(), num_actions)
+            logits[0] = self._shift_buffer(self.best_logits.unsqueeze(0), num_actions)[0]  # Warm start keeps the previous best plan
+        else:
+            logits = torch.randn(self.restarts, self.horizon, num_actions)
+        return logits.requires_grad_()
+
+    def _shift_buffer(self, logits, num_actions):
+        return torch.cat([logits[:, 1:], torch.randn(logits.size(0), 1, num_actions)], dim=1)
 
-    def _initialize_sequence(self, environment):
-        if self.is_shift_buffer and self.logit_sequence is not None:
-            sequence = self._shift_buffer(environment, self.logit_sequence)
+    def _gradient_step(self, total_rewards):  # Restarts are independent, so the summed loss gives each its own gradient
+        if self._is_reentrant_checkpoint():  # Reentrant checkpointing only supports backward, the model weights are frozen instead
+            self.logits.grad = None
+            (-total_rewards.sum()).backward()
         else:
-            sequence = [torch.tensor(environment.sample_logits(), requires_grad=True) for _ in range(self.horizon)]
-        return sequence
+            self.logits.grad, = torch.autograd.grad(-total_rewards.sum(), self.logits)  # Frees the graph, model weights get no gradients
+        self.optimizer.step()
 
-    def _convert_action_to_value(self, action):
-        return [sub_action.item() for sub_action in action]
+    def _is_reentrant_checkpoint(self):
+        return self.is_differentiable_dream and self.checkpoint_length > 0 and not IS_NON_REENTRANT_CHECKPOINT
 
-    def _convert_tensor_sequence_to_sequence(self, sequence):
-        return [self._convert_action_to_value(action) for action in sequence]
+    def _freeze_model_parameters(self, environment):
+        modules = [environment.mdrnn] + ([environment.mdrnn_cell] if environment.mdrnn_cell is not None else [])
+        parameters = [parameter for module in modules for parameter in module.parameters() if parameter.requires_grad]
+        for parameter in parameters:
+            parameter.requires_grad_(False)
+        return parameters
 
-    def _shift_buffer(self, environment, sequence):
-        sequence.pop(0)
-        sequence.append(torch.tensor(environment.sample_logits(), requires_grad=True))
-        return sequence
+    def _evaluate_plans(self, actions, environment):  # actions: (restarts, horizon, num_actions) -> total rewards: (restarts,)
+        if self.is_differentiable_dream:
+            return self._evaluate_plans_differentiable(actions, environment)
+        latents = self.latent.repeat(self.restarts, 1)
+        hiddens = [state.repeat(1, self.restarts, 1) for state in self.hidden]
+        total_rewards = torch.zeros(self.restarts)
+        is_alive = torch.ones(self.restarts, dtype=torch.bool)
 
-    def _gradient_step(self,  total_reward):
-        self.optimizer.zero_grad()
-        (-total_reward).backward(retain_graph=True)  # TODO check mem leak
-        self.optimizer.step()
+        for step in range(self.horizon):
+            latents, rewards, dones, hiddens = environment.step_batch(actions[:, step], hiddens, latents)
+            total_rewards = total_rewards + rewards * is_alive  # Mask out restarts that are done
+            is_alive = is_alive & ~dones
+            if not is_alive.any():
+                break
+        return total_rewards
+
+    def _evaluate_plans_differentiable(self, actions, environment):
+        latents = self.latent.repeat(self.restarts, 1)
+        hidden, cell = [state.repeat(1, self.restarts, 1) for state in self.hidden]
+        total_rewards = torch.zeros(self.restarts)
+        is_alive = torch.ones(self.restarts, dtype=torch.bool)
+        segment_length = self.checkpoint_length if self.checkpoint_length > 0 else self.horizon
 
-    def _evaluate_plan(self, actions, environment):
-        is_done = False
-        total_reward = 0
-        latent = self.latent
-        hidden = self.hidden
-
-        for action in actions:
-            if not is_done:
-                latent, reward, is_done, hidden = environment.step(action, hidden, latent, is_simulation_real_environment=False, is_reward_tensor=True)
-                total_reward += reward
-            else:
+        for start in range(0, self.horizon, segment_length):  # Checkpointed segments are recomputed in backward, bounding memory
+            segment_actions = actions[:, start:start + segment_length]
+            segment = self._checkpoint_segment(environment, start, segment_actions, latents, hidden, cell, is_alive) \
+                      if self.checkpoint_length > 0 else self._unroll_segment(environment, start, segment_actions, latents, hidden, cell, is_alive)
+            segment_rewards, latents, hidden, cell, is_alive = segment
+            total_rewards = total_rewards + segment_rewards
+            if not is_alive.any():
                 break
-        return total_reward
+        return total_rewards
+
+    def _checkpoint_segment(self, environment, start, actions, latents, hidden, cell, is_alive):
+        if IS_NON_REENTRANT_CHECKPOINT:
+            return checkpoint(self._unroll_segment, environment, start, actions, latents, hidden, cell, is_alive, use_reentrant=False)
+
+        # Reentrant checkpointing saves its inputs for backward, so only float tensors go through it
+        def unroll_segment(actions, latents, hidden, cell, is_alive):
+            total_rewards, latents, hidden, cell, is_alive = self._unroll_segment(environment, start, actions, latents, hidden, cell, is_alive > 0)
+            return total_rewards, latents, hidden, cell, is_alive.float()
+        total_rewards, latents, hidden, cell, is_alive = checkpoint(unroll_segment, actions, latents, hidden, cell, is_alive.float())
+        return total_rewards, latents, hidden, cell, is_alive > 0
+
+    def _unroll_segment(self, environment, start, actions, latents, hidden, cell, is_alive):
+        total_rewards = torch.zeros(self.restarts)
+        hiddens = [hidden, cell]
+        for step in range(start, start + actions.size(1)):
+            if self.truncation_length > 0 and step > 0 and step % self.truncation_length == 0:  # Truncated backpropagation through time
+                latents, hiddens = latents.detach(), [state.detach() for state in hiddens]
+            latents, rewards, dones, hiddens = environment.step_batch_differentiable(actions[:, step - start], hiddens, latents, self.noise[step],
+                                                                                     self.mixture_relaxation, self.gumbel_temperature)
+            total_rewards = total_rewards + rewards * is_alive
+            is_alive = is_alive & ~dones
+        return total_rewards, latents, hiddens[0], hiddens[1], is_alive
@@ -5,8 +5,11 @@
 #  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
 
 import math
+import torch
 import random
+from collections import OrderedDict
 from planning.interfaces.node import Node
+from planning.interfaces.array_tree import ArrayTree
 from planning.interfaces.abstract_tree_search_simulation import AbstractTreeSearch
 
 
@@ -18,16 +21,42 @@ def uct(node, temperature=None):  # Upper Confidence Bound for Trees
 
 class MCTS(AbstractTreeSearch):
 
-    def __init__(self, temperature, max_rollouts, rollout_length, is_discrete_delta):
+    def __init__(self, temperature, max_rollouts, rollout_length, is_discrete_delta, is_parallel_leaves=False, leaves_per_wave=8,
+                 virtual_loss=1.0, is_transition_cache=False, max_cached_transitions=10000):
         super().__init__(temperature, max_rollouts, rollout_length)
         self.is_discrete_delta = is_discrete_delta
+        self.is_parallel_leaves = is_parallel_leaves
+        self.leaves_per_wave = leaves_per_wave
+        self.virtual_loss = virtual_loss
+        self.is_transition_cache = is_transition_cache
+        self.max_cached_transitions = max_cached_transitions
+        self.transition_cache = OrderedDict()  # Nodes holding a cached transition in least recently used order
         self.latent = None
         self.hidden = None
 
     def search(self, environment, latent, hidden):
+        self.run_rollouts(environment, latent, hidden)
+        best_child = self._select_best_child(self.root, temperature=0)
+
+        self.root = best_child
+        self.root.parent = None
+
+        return best_child.action
+
+    def run_rollouts(self, environment, latent, hidden):  # Grows the reused tree from latent and hidden without choosing an action
+        self._init_root(environment)
+        self._clear_transition_cache()  # Cached transitions start from the previous root state
+
+        if self.is_parallel_leaves:
+            self._search_parallel_leaves(environment, latent, hidden)
+        else:
+            self._search_sequential(environment, latent, hidden)
+
+    def _init_root(self, environment):
         action = [0., 0., 0.] if self.root is None else self.root.action
         self.root = Node(action=action, actions=environment.discrete_action_space(action)) if self.root is None else self.root  # Reuse tree
 
+    def _search_sequential(self, environment, latent, hidden):
         for _ in range(self.max_rollouts):
             total_reward = 0
             self.latent = latent
@@ -43,12 +72,50 @@ class MCTS(AbstractTreeSearch):
 
             self._backpropagation(node, total_reward)
 
-        best_child = self._select_best_child(self.root, temperature=0)
+    def _search_parallel_leaves(self, environment, latent, hidden):
+        # Waves of K leaves: virtual loss steers the selections in a wave apart and their rollouts run as one MDRNN batch
+        remaining_rollouts = self.max_rollouts
+        while remaining_rollouts > 0:
+            leaves = []
+            for _ in range(min(self.leaves_per_wave, remaining_rollouts)):
+                self.latent = latent
+                self.hidden = hidden
+                path_reward, node, is_done = self._selection(self.root, environment)
+                if not is_done:
+                    expansion_reward, node, is_done = self._expansion(node, environment)
+                    path_reward += expansion_reward
+                self._apply_virtual_loss(node)
+                leaves.append((node, path_reward, self.latent, self.hidden, is_done))
 
-        self.root = best_child
-        self.root.parent = None
+            simulation_rewards = self._simulation_batch(environment, leaves)
+            for (node, path_reward, _, _, _), simulation_reward in zip(leaves, simulation_rewards):
+                self._apply_virtual_loss(node, is_revert=True)
+                self._backpropagation(node, path_reward + simulation_reward)
+            remaining_rollouts -= len(leaves)
 
-        return best_child.action
+    def _apply_virtual_loss(self, node, is_revert=False):
+        sign = -1 if is_revert else 1
+        while node:
+            node.visit_count += sign
+            node.total_reward -= sign * self.virtual_loss
+            node = node.parent
+
+    def _simulation_batch(self, environment, leaves):
+        latents = torch.cat([leaf_latent for _, _, leaf_latent, _, _ in leaves])
+        hiddens = [torch.cat([leaf_hidden[i] for _, _, _, leaf_hidden, _ in leaves], dim=1) for i in range(2)]
+        is_alive = torch.tensor([not is_done for _, _, _, _, is_done in leaves])
+        simulation_rewards = torch.zeros(len(leaves))
+        random_actions = [None] * len(leaves)
+        with torch.no_grad():
+            for _ in range(self.rollout_length):
+                if not is_alive.any():
+                    break
+                random_actions = [environment.discrete_delta_sample(random_action) if self.is_discrete_delta else environment.discrete_sample()
+                                  for random_action in random_actions]
+                latents, rewards, dones, hiddens = environment.step_batch(random_actions, hiddens, latents)
+                simulation_rewards += rewards * is_alive
+                is_alive &= ~dones
+        return simulation_rewards.tolist()
 
     def _selection(self, node, environment):
         is_done = False
@@ -56,8 +123,7 @@ class MCTS(AbstractTreeSearch):
         while node.children:
             if node.is_fully_expanded():
                 node = self._select_best_child(node)
-                self.latent, reward, is_done, self.hidden = environment.step(node.action, self.hidden, self.latent,
-                                                                             is_simulation_real_environment=False)
+                reward, is_done = self._step_node(node, environment)
                 selection_reward += reward
             else:
                 break
@@ -67,13 +133,62 @@ class MCTS(AbstractTreeSearch):
     def _expansion(self, node, environment):
         random_index = random.randrange(len(node.actions))
         random_action = node.actions.pop(random_index)
-        self.latent, reward, is_done, self.hidden = environment.step(node.action, self.hidden, self.latent,
-                                                                     is_simulation_real_environment=False)
         actions = environment.discrete_action_space(random_action)
         child_node = Node(parent=node, action=random_action, actions=actions)
         node.children.append(child_node)
+        reward, is_done = self._step_node(child_node, environment)
         return reward, child_node, is_done
 
+    def _step_node(self, node, environment):  # Transition into node from the current latent and hidden state
+        if node.transition is not None:
+            self.transition_cache.move_to_end(node)
+            self.latent, reward, is_done, self.hidden = node.transition
+            return reward, is_done
+
+        self.latent, reward, is_done, self.hidden = environment.step(node.action, self.hidden, self.latent,
+                                                                     is_simulation_real_environment=False)
+        if self.is_transition_cache:
+            node.transition = (self.latent, reward, is_done, self.hidden)
+            self.transition_cache[node] = None
+            if len(self.transition_cache) > self.max_cached_transitions:
+                evicted_node, _ = self.transition_cache.popitem(last=False)
+                evicted_node.transition = None
+                self._evict_descendant_transitions(evicted_node)
+        return reward, is_done
+
+    def _evict_descendant_transitions(self, node):  # They were stepped from the evicted state, which is re-sampled on the next visit
+        nodes = list(node.children)
+        while nodes:
+            node = nodes.pop()
+            if node.transition is not None:
+                node.transition = None
+                del self.transition_cache[node]
+                nodes.extend(node.children)
+
+    def _clear_transition_cache(self):
+        for node in self.transition_cache:
+            node.transition = None
+        self.transition_cache.clear()
+
+    def get_transition_cache_error(self, environment, latent, hidden):
+        """
+        Max difference between every cached transition and a recomputation from its parent's cached state (latent and hidden for
+        the root), inf if a parent state is no longer cached. Only meaningful for deterministic transitions and before rerooting
+        """
+        max_error = 0
+        for node in self.transition_cache:
+            if node.parent is not self.root and node.parent.transition is None:
+                return math.inf
+            parent_state = (latent, hidden) if node.parent is self.root else (node.parent.transition[0], node.parent.transition[3])
+            max_error = max(max_error, self._get_transition_error(environment, node.action, parent_state, node.transition))
+        return max_error
+
+    def _get_transition_error(self, environment, action, parent_state, transition):
+        next_latent, reward, _, next_hidden = environment.step(action, parent_state[1], parent_state[0], is_simulation_real_environment=False)
+        cached_latent, cached_reward, _, cached_hidden = transition
+        return max([(next_latent - cached_latent).abs().max().item(), abs(float(reward) - float(cached_reward))] +
+                   [(state - cached_state).abs().max().item() for state, cached_state in zip(next_hidden, cached_hidden)])
+
     def _simulation(self, environment, is_done):
         simulation_reward = 0
         simulation_counter = 0
@@ -95,3 +210,90 @@ class MCTS(AbstractTreeSearch):
     def _select_best_child(self, node, temperature=None, selection_criteria=uct):
         temperature = temperature if temperature is not None else self.temperature
         return max(node.children, key=lambda child: selection_criteria(child, temperature))
+
+
+class ArrayMCTS(MCTS):  # Same search on a struct-of-arrays tree: nodes are integer indices into self.tree
+    def __init__(self, temperature, max_rollouts, rollout_length, is_discrete_delta, is_parallel_leaves=False, leaves_per_wave=8,
+                 virtual_loss=1.0, is_transition_cache=False, max_cached_transitions=10000):
+        super().__init__(temperature, max_rollouts, rollout_length, is_discrete_delta, is_parallel_leaves, leaves_per_wave, virtual_loss,
+                         is_transition_cache, max_cached_transitions)
+        self.tree = None
+
+    def search(self, environment, latent, hidden):
+        self.run_rollouts(environment, latent, hidden)
+        best_child = self._select_best_child(self.root, temperature=0)
+        best_action = self.tree.get_action(best_child).tolist()
+        self.root = self.tree.reroot(best_child)
+        return best_action
+
+    def _init_root(self, environment):
+        if self.root is None:
+            self.tree = ArrayTree(environment.discrete_action_space())
+            self.root = self.tree.add_node()  # Reuse tree
+
+    def _selection(self, node, environment):
+        is_done = False
+        selection_reward = 0
+        while self.tree.num_children[node] > 0 and self.tree.is_fully_expanded(node):
+            node = self._select_best_child(node)
+            reward, is_done = self._step_node(node, environment)
+            selection_reward += reward
+        return selection_reward, node, is_done
+
+    def _expansion(self, node, environment):
+        untried_action_indices = self.tree.get_untried_action_indices(node)
+        random_action_index = untried_action_indices[random.randrange(len(untried_action_indices))]
+        child_node = self.tree.add_node(node, random_action_index)
+        reward, is_done = self._step_node(child_node, environment)
+        return reward, child_node, is_done
+
+    def _step_node(self, node, environment):
+        if node in self.transition_cache:
+            self.transition_cache.move_to_end(node)
+            self.latent, reward, is_done, self.hidden = self.transition_cache[node]
+            return reward, is_done
+
+        self.latent, reward, is_done, self.hidden = environment.step(self.tree.get_action(node), self.hidden, self.latent,
+                                                                     is_simulation_real_environment=False)
+        if self.is_transition_cache:
+            self.transition_cache[node] = (self.latent, reward, is_done, self.hidden)
+            if len(self.transition_cache) > self.max_cached_transitions:
+                evicted_node, _ = self.transition_cache.popitem(last=False)
+                self._evict_descendant_transitions(evicted_node)
+        return reward, is_done
+
+    def _evict_descendant_transitions(self, node):
+        nodes = list(self.tree.get_children(node))
+        while nodes:
+            node = nodes.pop()
+            if node in self.transition_cache:
+                del self.transition_cache[node]
+                nodes.extend(self.tree.get_children(node))
+
+    def _clear_transition_cache(self):  # Node indices also change when the tree is rerooted
+        self.transition_cache.clear()
+
+    def get_transition_cache_error(self, environment, latent, hidden):
+        max_error = 0
+        for node, transition in self.transition_cache.items():
+            parent = self.tree.parents[node]
+            if parent != self.root and parent not in self.transition_cache:
+                return math.inf
+            parent_state = (latent, hidden) if parent == self.root else (self.transition_cache[parent][0], self.transition_cache[parent][3])
+            max_error = max(max_error, self._get_transition_error(environment, self.tree.get_action(node), parent_state, transition))
+        return max_error
+
+    def _backpropagation(self, node, total_reward):
+        path = self.tree.get_path(node)
+        self.tree.visit_counts[path] += 1
+        self.tree.total_rewards[path] += total_reward
+
+    def _apply_virtual_loss(self, node, is_revert=False):
+        sign = -1 if is_revert else 1
+        path = self.tree.get_path(node)
+        self.tree.visit_counts[path] += sign
+        self.tree.total_rewards[path] -= sign * self.virtual_loss
+
+    def _select_best_child(self, node, temperature=None, selection_criteria=None):
+        temperature = temperature if temperature is not None else self.temperature
+        return self.tree.select_uct_child(node, temperature)
@@ -17,13 +17,17 @@ from tqdm import tqdm
 
 class RMHC(AbstractRandomMutationHillClimbing):
     def __init__(self, horizon, max_generations, is_shift_buffer, is_rollout, max_rollouts=None, rollout_length=None,
-                 is_parallel_rollouts=False):
+                 is_parallel_rollouts=False, is_prefix_cache=False, is_common_random_numbers=False):
         super().__init__(horizon, max_generations, is_shift_buffer, is_rollout, max_rollouts, rollout_length)
         self.current_elite = None
         self.latent = None
         self.hidden = None
         self.elite_history = []
         self.is_parallel_rollouts = is_parallel_rollouts
+        self.is_prefix_cache = is_prefix_cache
+        self.elite_trajectory = None  # [(latent, hidden, total_reward, is_done)] per step of the elite's plan
+        self.is_common_random_numbers = is_common_random_numbers
+        self.noise = None  # Pre-drawn per search and shared by elite and mutants when using common random numbers
 
         self.evolution_handler = EvolutionHandler(self.horizon)
         self.mutation_operator = self.evolution_handler.get_mutation_operator()
@@ -32,8 +36,10 @@ class RMHC(AbstractRandomMutationHillClimbing):
         self.latent = latent
         self.hidden = hidden
         self.elite_history = []
+        self.elite_trajectory = None
+        self.noise = environment.sample_noise(self.horizon) if self.is_common_random_numbers else None
         self.current_elite = self._initialize_individual(environment)
-        self._evaluate_individual(self.current_elite, environment)
+        self.elite_trajectory = self._evaluate_individual(self.current_elite, environment)  # (Re)simulated from scratch since the plan may be shifted
         self._append_elite(self.current_elite)
 
         for generation in range(self.max_generations):
@@ -44,7 +50,8 @@ class RMHC(AbstractRandomMutationHillClimbing):
 
     def _step_generation(self, generation, environment):
         mutated_individual = self._mutate(environment, self.current_elite, generation)
-        self.current_elite = self._select_best_individual(self.current_elite, mutated_individual, environment)
+        start_index = self._get_first_mutated_index(self.current_elite, mutated_individual) if self.is_prefix_cache else 0
+        self.current_elite = self._select_best_individual(self.current_elite, mutated_individual, environment, start_index)
 
     def _initialize_individual(self, environment):
         if self.is_shift_buffer and self.current_elite is not None:
@@ -57,12 +64,26 @@ class RMHC(AbstractRandomMutationHillClimbing):
         individual.fitness, individual.age = 0, 0  # reset across generations
         return individual
 
-    def _select_best_individual(self, current_elite, mutated_individual, simulated_environment):
-        self._evaluate_individual(mutated_individual, simulated_environment)
-        elite = mutated_individual if mutated_individual.fitness > current_elite.fitness else current_elite
+    def _select_best_individual(self, current_elite, mutated_individual, simulated_environment, start_index=0):
+        mutated_trajectory = self._evaluate_individual(mutated_individual, simulated_environment, start_index)
+        is_mutation_better = mutated_individual.fitness > current_elite.fitness
+        elite = mutated_individual if is_mutation_better else current_elite
+        self.elite_trajectory = mutated_trajectory if is_mutation_better else self.elite_trajectory
         self._append_elite(elite)
         return elite
 
+    def _get_first_mutated_index(self, current_elite, mutated_individual):
+        for i, (elite_action, mutated_action) in enumerate(zip(current_elite.action_sequence, mutated_individual.action_sequence)):
+            if not np.array_equal(elite_action, mutated_action):
+                return i
+        return len(mutated_individual.action_sequence)
+
+    def _get_trajectory_prefix(self, start_index):
+        # Steps before the first mutated action are identical to the elite's, so resume from its cached states
+        if start_index <= 0 or self.elite_trajectory is None:
+            return [(self.latent, self.hidden, 0, False)]
+        return self.elite_trajectory[:min(start_index, len(self.elite_trajectory) - 1) + 1]
+
     def _shift_buffer(self, environment, individual):
         individual.action_sequence.pop(0)
         individual.action_sequence.append(environment.sample())
@@ -96,27 +117,31 @@ class RMHC(AbstractRandomMutationHillClimbing):
 
     def _mutate(self, environment, current_elite, generation):
         individual = copy.deepcopy(current_elite)
-        self.mutation_operator(environment, individual)
+        if self.evolution_handler.is_vectorized:
+            individual.action_sequence = self.mutation_operator(environment, np.array([individual.action_sequence]))[0].tolist()
+        else:
+            self.mutation_operator(environment, individual)
         individual.age, individual.fitness = generation + 1, 0
         return individual
 
-    def _evaluate_individual(self, individual, environment):
+    def _evaluate_individual(self, individual, environment, start_index=0):
         with torch.no_grad():
-            is_done = False
-            total_reward = 0
-            latent = self.latent
-            hidden = self.hidden
+            trajectory = self._get_trajectory_prefix(start_index)
+            latent, hidden, total_reward, is_done = trajectory[-1]
 
-            for action in individual.action_sequence:
+            for step, action in enumerate(individual.action_sequence[len(trajectory) - 1:], start=len(trajectory) - 1):
                 if not is_done:
-                    latent, reward, is_done, hidden = environment.step(action, hidden, latent, is_simulation_real_environment=False)
+                    latent, reward, is_done, hidden = environment.step(action, hidden, latent, is_simulation_real_environment=False,
+                                                                       noise=environment.get_step_noise(self.noise, step))
                     total_reward += reward
+                    trajectory.append((latent, hidden, total_reward, is_done))
                 else:
                     break
 
             if self.is_rollout and not is_done:
                 total_reward += self._rollout(environment, latent, hidden, self.is_parallel_rollouts)
             individual.fitness += total_reward
+            return trajectory
 
     def _append_elite(self, individual):
         is_new_elite = len(self.elite_history) is 0 or individual.age is not self.current_elite.age
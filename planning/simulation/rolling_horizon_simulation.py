@@ -6,6 +6,7 @@
 
 import copy
 import torch
+import numpy as np
 from planning.interfaces.individual import Individual
 from tuning.evolution_handler import EvolutionHandler
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -14,7 +15,7 @@ from planning.interfaces.abstract_rolling_horizon_simulation import AbstractRoll
 
 class RHEA(AbstractRollingHorizon):
     def __init__(self, population_size, horizon, max_generations, is_shift_buffer, is_rollout, max_rollouts=None, rollout_length=None,
-                 is_parallel_rollouts=False):
+                 is_parallel_rollouts=False, is_batch_evaluation=False, is_common_random_numbers=False):
         super().__init__(population_size, horizon, max_generations, is_shift_buffer, is_rollout, max_rollouts, rollout_length)
         print(self.is_rollout)
         print(self.max_rollouts)
@@ -24,6 +25,9 @@ class RHEA(AbstractRollingHorizon):
         self.elite_history = []
         self.current_elite = None
         self.is_parallel_rollouts = is_parallel_rollouts
+        self.is_batch_evaluation = is_batch_evaluation
+        self.is_common_random_numbers = is_common_random_numbers
+        self.noise = None  # Pre-drawn per search and shared by all individuals when using common random numbers
 
         self.evolution_handler = EvolutionHandler(self.horizon)
         self.selection_type = self.evolution_handler.get_selection_type()
@@ -36,6 +40,7 @@ class RHEA(AbstractRollingHorizon):
         self.hidden = hidden
         self.elite_history = []
         self.current_elite = None
+        self.noise = environment.sample_noise(self.horizon) if self.is_common_random_numbers else None
         self.population = self.initialize_population(environment, self.population_size)
 
         for generation in range(self.max_generations):
@@ -78,7 +83,9 @@ class RHEA(AbstractRollingHorizon):
     def evaluate_population(self, population, environment, is_parallel=True):
         population = population if self.current_elite is None else [individual for individual in population
                                                                     if individual is not self.current_elite]
-        if is_parallel:
+        if self.is_batch_evaluation:
+            self._evaluate_population_batch(population, environment)
+        elif is_parallel:
             with ThreadPoolExecutor() as executor:
                 processes = [executor.submit(lambda args: self._evaluate_individual(*args), [individual, environment])
                              for individual in population]
@@ -93,9 +100,10 @@ class RHEA(AbstractRollingHorizon):
             latent = self.latent
             hidden = self.hidden
 
-            for action in individual.action_sequence:
+            for step, action in enumerate(individual.action_sequence):
                 if not is_done:
-                    latent, reward, is_done, hidden = environment.step(action, hidden, latent, is_simulation_real_environment=False)
+                    latent, reward, is_done, hidden = environment.step(action, hidden, latent, is_simulation_real_environment=False,
+                                                                       noise=environment.get_step_noise(self.noise, step))
                     total_reward += reward
                 else:
                     break
@@ -104,6 +112,49 @@ class RHEA(AbstractRollingHorizon):
 
             individual.fitness += total_reward
 
+    def _evaluate_population_batch(self, population, environment):
+        if not population:
+            return
+        with torch.no_grad():
+            action_sequences = torch.tensor([individual.action_sequence for individual in population], dtype=torch.float32)
+            action_sequences = action_sequences.transpose(0, 1)  # (population, horizon, num_actions) -> (horizon, population, num_actions)
+            population_size = action_sequences.size(1)
+            latents = self.latent.repeat(population_size, 1)
+            hiddens = [state.repeat(1, population_size, 1) for state in self.hidden]
+            total_rewards = torch.zeros(population_size)
+            is_alive = torch.ones(population_size, dtype=torch.bool)
+
+            for step, actions in enumerate(action_sequences):  # One MDRNN forward for the whole population per time step
+                latents, rewards, dones, hiddens = environment.step_batch(actions, hiddens, latents, environment.get_step_noise(self.noise, step))
+                total_rewards += rewards * is_alive  # Mask out individuals that are done
+                is_alive &= ~dones
+                if not is_alive.any():
+                    break
+
+            if self.is_rollout:
+                total_rewards += self._rollout_batch(environment, latents, hiddens, is_alive)
+
+            for individual, total_reward in zip(population, total_rewards.tolist()):
+                individual.fitness += total_reward
+
+    def _rollout_batch(self, environment, latents, hiddens, is_alive):
+        population_size = latents.size(0)
+        batch_size = population_size * self.max_rollouts
+        latents = latents.repeat(self.max_rollouts, 1)  # (max_rollouts * population, latent_size)
+        hiddens = [state.repeat(1, self.max_rollouts, 1) for state in hiddens]
+        is_alive = is_alive.repeat(self.max_rollouts)
+        total_rewards = torch.zeros(batch_size)
+
+        for _ in range(self.rollout_length):
+            if not is_alive.any():
+                break
+            actions = torch.as_tensor(environment.sample_batch((batch_size,)), dtype=torch.float32)
+            latents, rewards, dones, hiddens = environment.step_batch(actions, hiddens, latents)
+            total_rewards += rewards * is_alive
+            is_alive &= ~dones
+
+        return total_rewards.view(self.max_rollouts, population_size).mean(dim=0)
+
     def _rollout(self, environment, latent, hidden, is_parallel=False):
         total_reward = 0
         if is_parallel:
@@ -131,6 +182,8 @@ class RHEA(AbstractRollingHorizon):
         return total_reward
 
     def evolve_population(self, environment, generation, population):
+        if self.evolution_handler.is_vectorized:
+            return self._evolve_population_batch(environment, generation, population)
         next_population = [self.current_elite]
         for _ in range(self.population_size - 1):
             parent_a, parent_b = self.selection_type(population)
@@ -138,6 +191,19 @@ class RHEA(AbstractRollingHorizon):
             next_population.append(child)
         return next_population
 
+    def _evolve_population_batch(self, environment, generation, population):  # All children from one selection, crossover and mutation pass
+        action_sequences = np.array([individual.action_sequence for individual in population])  # (population, horizon, num_actions)
+        fitnesses = np.array([individual.fitness for individual in population])
+        parents_a, parents_b = self.selection_type(fitnesses, self.population_size - 1)
+
+        if self.genetic_operator == 'mut':  # Fittest parent is mutated
+            children = action_sequences[np.where(fitnesses[parents_a] > fitnesses[parents_b], parents_a, parents_b)]
+        else:
+            children = self.crossover_operator(action_sequences[parents_a], action_sequences[parents_b])
+        if self.genetic_operator == 'mut' or self.genetic_operator == 'crossmut':
+            children = self.mutation_operator(environment, children)
+        return [self.current_elite] + [Individual(action_sequence, age=generation + 1) for action_sequence in children.tolist()]
+
     def variation(self, environment, parent_a, parent_b, generation):
         child = None
         if self.genetic_operator == 'cross' or self.genetic_operator == 'crossmut':
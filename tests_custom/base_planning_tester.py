@@ -13,6 +13,7 @@ from tests_custom.base_tester import BaseTester
 from planning.agent_factory import get_agent_parameters
 from concurrent.futures.process import ProcessPoolExecutor
 from utility.logging.planning_logger import PlanningLogger
+from utility.inference_server import InferenceServer, get_inference_client
 
 # ARGS KEYS PLANNING
 ACTION_HISTORY = 'action_history'
@@ -80,7 +81,19 @@ class BasePlanningTester(BaseTester):
         plt.close('all')
         return test_name, trial_actions, trial_rewards, trial_elites, trial_max_rewards, trial_seeds
 
+    def run_test_trials(self, trials):  # Every test with the given number of trials and no saved session -> {test_name: trial_rewards}
+        total_trials, self.trials = self.trials, trials
+        if self.is_multithread_tests:
+            self._share_models()
+            with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+                test_results = list(executor.map(self.run_specific_test, self.get_test_functions().keys()))
+        else:
+            test_results = [self.run_specific_test(test_name) for test_name in self.get_test_functions().keys()]
+        self.trials = total_trials
+        return {test_name: trial_rewards for test_name, _, trial_rewards, _, _, _ in test_results}
+
     def _run_multithread_new_test_session(self):
+        self._share_models()
         with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
             tests = self.get_test_functions()
             thread_results = list(executor.map(self.run_specific_test, tests.keys()))
@@ -124,19 +137,26 @@ class BasePlanningTester(BaseTester):
 
         if self.is_multithread_trials:
             func_input = [(trial_i, args, seed) for trial_i in range(self.trials)]
-
-            with ProcessPoolExecutor(max_workers=self._get_threads()) as executor:
-                thread_results = list(executor.map(self._run_trial_thread, func_input))
-                trial_i = 0
-                for elites, action_history, total_reward, max_reward, seed, custom_message in thread_results:
-                    trial_actions.append(action_history)
-                    trial_rewards.append(total_reward)
-                    trial_max_rewards.append(max_reward)
-                    trial_elites.append(elites)
-                    trial_seeds.append(seed)
-                    logger.log_trial_rewards(test_name=args[TEST_NAME], trial_idx=trial_i, total_reward=total_reward, max_reward=max_reward)
-                    logger.log_custom_trial_results(test_name=args[TEST_NAME], trial_idx=trial_i, results=custom_message)
-                    trial_i += 1
+            self._share_models()
+
+            if self.config['inference_server']['is_inference_server']:  # One batched model process serves all trial workers
+                with InferenceServer(self.config, self.vae, self.mdrnn, num_clients=self._get_threads()) as server:
+                    initializer, initargs = server.get_initializer()
+                    with ProcessPoolExecutor(max_workers=self._get_threads(), initializer=initializer, initargs=initargs) as executor:
+                        thread_results = list(executor.map(self._run_trial_thread, func_input))
+            else:
+                with ProcessPoolExecutor(max_workers=self._get_threads()) as executor:
+                    thread_results = list(executor.map(self._run_trial_thread, func_input))
+            trial_i = 0
+            for elites, action_history, total_reward, max_reward, seed, custom_message in thread_results:
+                trial_actions.append(action_history)
+                trial_rewards.append(total_reward)
+                trial_max_rewards.append(max_reward)
+                trial_elites.append(elites)
+                trial_seeds.append(seed)
+                logger.log_trial_rewards(test_name=args[TEST_NAME], trial_idx=trial_i, total_reward=total_reward, max_reward=max_reward)
+                logger.log_custom_trial_results(test_name=args[TEST_NAME], trial_idx=trial_i, results=custom_message)
+                trial_i += 1
         else:
             for i in tqdm(range(self.trials), desc=f'Planning Test on {args[TEST_NAME]} with {self.trials} trials'):
                 elites, action_history, total_reward, max_reward, seed, custom_message = self._run_trial(i, args, seed)
@@ -151,7 +171,12 @@ class BasePlanningTester(BaseTester):
         logger.end_log()
         return trial_actions, trial_rewards, trial_elites, trial_max_rewards, trial_seeds
 
+    def _share_models(self):  # self is pickled per task, shared weights are sent as handles instead of full copies
+        self.vae.share_memory()
+        self.mdrnn.share_memory()
+
     def _run_trial_thread(self, args):
+        self.simulated_environment.inference_client = get_inference_client()
         return self._run_trial(args[0], args[1], args[2])
 
     def _run_cached_session(self):
@@ -16,7 +16,9 @@ class BaseTester:
         self.trials = trials
 
     def _encode_state(self, state):
-        state = self.preprocessor.resize_frame(state).unsqueeze(0)
+        state = self.preprocessor.preprocess_frame(state)
+        if self.simulated_environment.inference_client is not None:  # Planning only needs the latent, decoding is skipped
+            return self.vae.sample_reparametarization(*self.simulated_environment.inference_client.encode(state)), None
         decoded_state, z_mean, z_log_standard_deviation = self.vae(state)
         latent_state = self.vae.sample_reparametarization(z_mean, z_log_standard_deviation)
         return latent_state, decoded_state
@@ -1,10 +1,13 @@
+import copy
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.spatial.distance as dist
 from tests_custom.base_tester import BaseTester
 from gym.envs.box2d.car_dynamics import Car
+from mdrnn.mdrnn import get_mdrnn_cell
 from environment.simulated_environment import SimulatedEnvironment
+from planning.simulation.mcts_simulation import MCTS, ArrayMCTS
 
 
 class ModelTester(BaseTester):
@@ -20,6 +23,8 @@ class ModelTester(BaseTester):
         print(self.config['vae'])
         print(f'MDRNN Parameters')
         with torch.no_grad():
+            self._mdrnn_cell_parity_test()
+            self._mcts_transition_cache_test()
             self._forward_drive_slow_test()
             self._forward_drive_medium_test()
             self._forward_drive_fast_test()
@@ -35,6 +40,41 @@ class ModelTester(BaseTester):
             self._drive_pass_u_turn_test()
         plt.close('all')
 
+    def _mdrnn_cell_parity_test(self, batch_size=8, steps=20, tolerance=1e-5):
+        print(f'\n----- MDRNN cell parity test ------')
+        for is_torchscript in [False, True]:
+            mdrnn_cell = get_mdrnn_cell(self.mdrnn, is_torchscript)
+            hidden = [torch.zeros(1, batch_size, self.mdrnn.lstm.lstm.hidden_size) for _ in range(2)]
+            cell_hidden = [state[0] for state in hidden]
+            max_difference = 0
+            for _ in range(steps):
+                actions = torch.rand(batch_size, 3) * 2 - 1
+                latents = torch.randn(batch_size, self.config['latent_size'])
+                *outputs, hidden = self.mdrnn(actions.unsqueeze(0), latents.unsqueeze(0), hidden)
+                *cell_outputs, cell_hidden[0], cell_hidden[1] = mdrnn_cell(actions, latents, *cell_hidden)
+                differences = [(output[0] - cell_output).abs().max().item() for output, cell_output in zip(outputs + list(hidden), cell_outputs + cell_hidden)]
+                max_difference = max([max_difference] + differences)
+            print(f'TorchScript: {is_torchscript} | max abs difference: {max_difference:.2e} | passed: {max_difference < tolerance}')
+            if max_difference >= tolerance:
+                raise Exception(f'MDRNN cell (TorchScript: {is_torchscript}) differs from the MDRNN by {max_difference:.2e} '
+                                f'- tolerance {tolerance:.0e}')
+
+    def _mcts_transition_cache_test(self, max_rollouts=200, max_cached_transitions=10, tolerance=1e-5):
+        print(f'\n----- MCTS transition cache test ------')
+        config = copy.deepcopy(self.config)
+        config['simulated_environment']['transition_mode'] = 'expected_mean'  # Deterministic so cached transitions can be recomputed
+        environment = SimulatedEnvironment(config, self.vae, self.mdrnn)
+        latent, hidden = torch.randn(1, self.config['latent_size']), environment.get_hidden_zeros_state()
+        for mcts in [MCTS, ArrayMCTS]:
+            for is_parallel_leaves in [False, True]:
+                agent = mcts(1.41, max_rollouts, 5, False, is_parallel_leaves, 8, 1.0, True, max_cached_transitions)
+                agent.run_rollouts(environment, latent, hidden)
+                max_error = agent.get_transition_cache_error(environment, latent, hidden)
+                print(f'{mcts.__name__} | parallel leaves: {is_parallel_leaves} | max transition error: {max_error:.2e}')
+                if max_error >= tolerance:
+                    raise Exception(f'{mcts.__name__} (parallel leaves: {is_parallel_leaves}) cached transitions differ from their parent '
+                                    f'states by {max_error:.2e}')
+
     def _stand_still_test(self):
         print(f'\n----- Stand still test ------')
         actions = [([0, 0, 0], 80)]
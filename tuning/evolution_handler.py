@@ -21,6 +21,7 @@ class EvolutionHandler:
 
         self.mutation_probability = config['evolution_handler']['mutation_probability'] if "mutation_probability" in config['evolution_handler'] else 1 / self.horizon
         self.tournament_percentage = config['evolution_handler']['tournament_percentage']
+        self.is_vectorized = config['evolution_handler']['is_vectorized']  # Operators on (population, horizon, num_actions) arrays
 
         self.mutation_methods = {'single_uniform': self._single_uniform_mutation,
                                  'all_uniform': self._all_uniform_mutation,
@@ -35,6 +36,19 @@ class EvolutionHandler:
                                   'rank': self._rank_selection,
                                   'roulette': self._roulette_selection}
 
+        self.batch_mutation_methods = {'single_uniform': self._batch_single_uniform_mutation,
+                                       'all_uniform': self._batch_all_uniform_mutation,
+                                       'subset_mutation': self._batch_subset_mutation}
+
+        self.batch_crossover_methods = {'uniform': self._batch_uniform_crossover,
+                                        '1_bit': self._batch_one_bit_crossover,
+                                        '2_bit': self._batch_two_bit_crossover}
+
+        self.batch_selection_methods = {'uniform': self._batch_uniform_selection,
+                                        'tournament': self._batch_tournament_selection,
+                                        'rank': self._batch_rank_selection,
+                                        'roulette': self._batch_roulette_selection}
+
         self.genetic_operator = {'crossover': 'cross',
                                  "mutation": 'mut',
                                  "crossover_mutation": 'crossmut'}
@@ -52,15 +66,15 @@ class EvolutionHandler:
 
     def get_mutation_operator(self, mutation_method=None):
         mutation_method = self.default_mutation_method if mutation_method is None else mutation_method
-        return self.mutation_methods[mutation_method]
+        return self.batch_mutation_methods[mutation_method] if self.is_vectorized else self.mutation_methods[mutation_method]
 
     def get_crossover_operator(self, crossover_method=None):
         crossover_method = self.default_crossover_method if crossover_method is None else crossover_method
-        return self.crossover_methods[crossover_method]
+        return self.batch_crossover_methods[crossover_method] if self.is_vectorized else self.crossover_methods[crossover_method]
 
     def get_selection_type(self, selection_method=None):
         selection_method = self.default_selection_method if selection_method is None else selection_method
-        return self.selection_methods[selection_method]
+        return self.batch_selection_methods[selection_method] if self.is_vectorized else self.selection_methods[selection_method]
 
     # SELECTION METHODS
     def _uniform_selection(self, population):
@@ -163,3 +177,71 @@ class EvolutionHandler:
         for i in mutation_indices:
             child.action_sequence[i] = mutations.pop(0)
 
+    # BATCH SELECTION METHODS - fitnesses: (population,) -> parent indices a, b: (num_pairs,)
+    def _batch_uniform_selection(self, fitnesses, num_pairs):
+        parents_a = np.random.randint(len(fitnesses), size=num_pairs)
+        parents_b = (parents_a + np.random.randint(1, len(fitnesses), size=num_pairs)) % len(fitnesses)  # Never parent a
+        return parents_a, parents_b
+
+    def _batch_tournament_selection(self, fitnesses, num_pairs):
+        tournament_size = int(len(fitnesses) * self.tournament_percentage) if len(fitnesses) > 2 else len(fitnesses)
+        tournaments = np.argsort(np.random.rand(num_pairs, len(fitnesses)), axis=1)[:, :tournament_size]  # Random subset per pair
+        tournaments = np.take_along_axis(tournaments, np.argsort(-fitnesses[tournaments], axis=1, kind='stable'), axis=1)
+        return tournaments[:, 0], tournaments[:, 1]
+
+    def _batch_rank_selection(self, fitnesses, num_pairs):
+        ranks = np.empty(len(fitnesses))
+        ranks[np.argsort(fitnesses, kind='stable')] = np.arange(1, len(fitnesses) + 1)
+        return self._sample_distinct_pairs(ranks, num_pairs)
+
+    def _batch_roulette_selection(self, fitnesses, num_pairs):
+        if (fitnesses < 0).any():  # Normalize negative values to positive by summing smallest value
+            fitnesses = fitnesses + abs(fitnesses.min()) + 0.01
+        return self._sample_distinct_pairs(fitnesses, num_pairs)
+
+    def _sample_distinct_pairs(self, wheel, num_pairs):  # Parent b is drawn from the wheel without parent a, like the rejection loop
+        wheels = np.tile(np.asarray(wheel, dtype=np.float64), (num_pairs, 1))
+        parents_a = self._spin_wheels(wheels)
+        wheels[np.arange(num_pairs), parents_a] = 0
+        return parents_a, self._spin_wheels(wheels)
+
+    def _spin_wheels(self, wheels):  # Row-wise inverse CDF of unnormalized wheels
+        cumulative_wheels = wheels.cumsum(axis=1)
+        spins = np.random.rand(len(wheels), 1) * cumulative_wheels[:, -1:]
+        return np.minimum((cumulative_wheels <= spins).sum(axis=1), wheels.shape[1] - 1)
+
+    # BATCH CROSSOVER METHODS - parents: (num_children, horizon, num_actions) -> children of the same shape
+    def _batch_uniform_crossover(self, parents_a, parents_b):
+        return np.where(np.random.rand(*parents_a.shape[:2], 1) < 0.5, parents_a, parents_b)
+
+    def _batch_one_bit_crossover(self, parents_a, parents_b):
+        return self._batch_n_bit_crossover(parents_a, parents_b, bit=1)
+
+    def _batch_two_bit_crossover(self, parents_a, parents_b):
+        return self._batch_n_bit_crossover(parents_a, parents_b, bit=2)
+
+    def _batch_n_bit_crossover(self, parents_a, parents_b, bit):
+        num_children, horizon_length = parents_a.shape[:2]
+        bit = min(bit, horizon_length - 1)
+        split_points = np.argsort(np.random.rand(num_children, horizon_length - 1), axis=1)[:, :bit] + 1
+        segments = (np.arange(horizon_length) >= split_points[:, :, None]).sum(axis=1)  # (num_children, horizon) segment of each action
+        first_parents = np.random.randint(2, size=(num_children, 1))  # Random parent for the first segment, then alternate
+        return np.where(((segments + first_parents) % 2 == 0)[..., None], parents_a, parents_b)
+
+    # BATCH MUTATION METHODS - children: (num_children, horizon, num_actions) -> mutated copy
+    def _batch_single_uniform_mutation(self, environment, children):
+        mutation_mask = np.zeros(children.shape[:2], dtype=bool)
+        mutation_mask[np.arange(len(children)), np.random.randint(children.shape[1], size=len(children))] = \
+            np.random.rand(len(children)) < self.mutation_probability
+        return self._apply_mutations(environment, children, mutation_mask)
+
+    def _batch_all_uniform_mutation(self, environment, children):
+        return self._apply_mutations(environment, children, np.random.rand(*children.shape[:2]) < self.mutation_probability)
+
+    def _batch_subset_mutation(self, environment, children):
+        mutation_mask = np.random.rand(*children.shape[:2]) < self.mutation_probability
+        mutation_mask[np.arange(len(children)), np.random.randint(children.shape[1], size=len(children))] = True  # At least one
+        return self._apply_mutations(environment, children, mutation_mask)
+
+    def _apply_mutations(self, environment, children, mutation_mask):
+        return np.where(mutation_mask[..., None], environment.sample_batch(children.shape[:2]), children)
@@ -5,13 +5,13 @@
 #  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
 
 import os
-import copy
 import logging
 import numpy as np
 import dill as pickle
 from tqdm import tqdm
 from os.path import join, exists
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from torch import multiprocessing
 
 
 class Mutator(object):
@@ -71,6 +71,13 @@ class Evaluator(object):
     def evaluate(self, x):
         raise NotImplementedError()
 
+    def race(self, x, incumbent_lower_bound):
+        '''
+        Evaluate x, allowed to stop early once x cannot beat the incumbent lower confidence bound.
+        Returns the fitness, the evaluated fraction of a full evaluation and a lower confidence bound (None without one)
+        '''
+        return self.evaluate(x), 1.0, None
+
 
 class BanditLandscapeModel(object):
 
@@ -86,7 +93,13 @@ class BanditLandscapeModel(object):
     def init(self):
         raise NotImplementedError()
 
-    def add_evaluated_point(self, point, fitness):
+    def add_evaluated_point(self, point, fitness, weight=1.0):
+        raise NotImplementedError()
+
+    def add_pending_point(self, point):
+        raise NotImplementedError()
+
+    def remove_pending_point(self, point):
         raise NotImplementedError()
 
     def get_mean_estimtate(self, point):
@@ -95,6 +108,12 @@ class BanditLandscapeModel(object):
     def get_exploration_estimate(self, point):
         raise NotImplementedError()
 
+    def get_mean_estimates(self, points):
+        raise NotImplementedError()
+
+    def get_exploration_estimates(self, points):
+        raise NotImplementedError()
+
     def get_tuple_data(self):
         raise NotImplementedError()
 
@@ -105,6 +124,8 @@ class BanditLandscapeModel(object):
 class NTupleLandscape(BanditLandscapeModel):
     '''
     The N-tuple landscape implementation
+    Statistics of all tuples live in flat arrays: every 1- and 2-tuple owns a dense block indexed by the encoded values of its dimensions,
+    larger tuples map the encoded values they have seen to slots appended after the dense blocks
     '''
 
     def __init__(self, search_space, tuple_config=None, ucb_epsilon=0.5):
@@ -114,26 +135,75 @@ class NTupleLandscape(BanditLandscapeModel):
         # If we dont have a tuple config, we just create a default tuple config, the 1-tuples and N-tuples
         if tuple_config == None:
             tuple_config = [1, search_space.get_num_dims()]
+        self._search_space = search_space
         self._tuple_config = set(tuple_config)
         self._tuples = list()
         self._ndims = search_space.get_num_dims()
         self._sampled_points = set()
         self._ucb_epsilon = ucb_epsilon
-        self._tuple_stats = None
+        self._value_indices = None  # Per dimension: str(value) -> index among the valid values of the dimension
+        self._strides = None  # (tuples, ndims): encoded point @ strides.T + offsets = the statistics index of each tuple
+        self._offsets = None
+        self._sparse_slots = None  # Per tuple: encoded tuple value -> statistics index, None for dense tuples
+        self._empty_slot = None  # Always zero, read by unseen values of sparse tuples
+        self._counts = None
+        self._sums = None
+        self._sums_squared = None
+        self._totals = None  # Evaluations per tuple
+        self._pending_counts = None  # In-flight evaluations per tuple value, never saved with the session
+        self._pending_totals = None
         self.reset()
 
     def reset(self):
-        self._tuple_stats = defaultdict(
-            lambda: defaultdict(
-                lambda: {
-                    'n': 0,
-                    'min': 0.0,
-                    'max': 0.0,
-                    'sum': 0.0,
-                    'sum_squared': 0.0
-                }
-            )
-        )
+        size = self._build_tuple_index()
+        self._counts = np.zeros(size)
+        self._sums = np.zeros(size)
+        self._sums_squared = np.zeros(size)
+        self._totals = np.zeros(len(self._tuples))
+        self._pending_counts = np.zeros(size)
+        self._pending_totals = np.zeros(len(self._tuples))
+
+    def _build_tuple_index(self):
+        valid_values = [self._search_space.get_valid_values_in_dim(dim) for dim in range(self._ndims)]
+        self._value_indices = [{str(value): index for index, value in enumerate(values)} for values in valid_values]
+        dim_sizes = np.array([len(values) for values in valid_values], dtype=np.int64)
+
+        self._strides = np.zeros((len(self._tuples), self._ndims), dtype=np.int64)
+        self._offsets = np.zeros(len(self._tuples), dtype=np.int64)
+        self._sparse_slots = [{} if len(tup) > 2 else None for tup in self._tuples]
+        size = 0
+        for tuple_index, tup in enumerate(self._tuples):
+            tuple_sizes = dim_sizes[tup]
+            self._strides[tuple_index, tup] = np.append(np.cumprod(tuple_sizes[::-1])[::-1][1:], 1)  # Row-major within the block
+            if self._sparse_slots[tuple_index] is None:
+                self._offsets[tuple_index] = size
+                size += int(np.prod(tuple_sizes))
+        self._empty_slot = size
+        return size + 1
+
+    def encode_points(self, points):
+        """
+        Map points to the indices of their values in each dimension of the search space: (points, ndims)
+        """
+        return np.array([[self._value_indices[dim][str(value)] for dim, value in enumerate(point)] for point in points],
+                        dtype=np.int64).reshape(-1, self._ndims)
+
+    def _get_statistics_indices(self, points, is_allocating=False):  # (points, tuples)
+        indices = self.encode_points(points) @ self._strides.T + self._offsets
+        for tuple_index, slots in enumerate(self._sparse_slots):
+            if slots is not None:
+                indices[:, tuple_index] = [self._get_sparse_slot(tuple_index, int(code), is_allocating) for code in indices[:, tuple_index]]
+        return indices
+
+    def _get_sparse_slot(self, tuple_index, code, is_allocating):
+        slots = self._sparse_slots[tuple_index]
+        if code not in slots:
+            if not is_allocating:
+                return self._empty_slot
+            slots[code] = self._counts.size
+            self._counts, self._sums, self._sums_squared, self._pending_counts = \
+                [np.append(stats, 0.) for stats in (self._counts, self._sums, self._sums_squared, self._pending_counts)]
+        return slots[code]
 
     def get_tuple_combinations(self, r, ndims):
         '''
@@ -164,91 +234,87 @@ class NTupleLandscape(BanditLandscapeModel):
         '''
         Create the index combinations for each of the n-tules
         '''
+        # A reloaded session already holds its tuples and statistics
+        if self._tuples:
+            return
+
         # Create all possible tuples for each
         for n in self._tuple_config:
             n_tuples = [tup for tup in self.get_tuple_combinations(n, self._ndims)]
             self._tuples.extend(n_tuples)
             self._logger.debug('Added %d-tuples: %s' % (n, n_tuples))
 
+        self.reset()
         self._logger.info('Tuple Landscape Size: %d' % len(self._tuples))
 
-    def add_evaluated_point(self, point, fitness):
+    def add_evaluated_point(self, point, fitness, weight=1.0):
         """
-        Add a point and it's fitness to the tuple landscape
+        Add a point and it's fitness to the tuple landscape, partially evaluated points count as a fraction of a visit
         """
 
         self._sampled_points.add(tuple(point))
 
-        for tup in self._tuples:
-            # The search space value is the values given by applying the tuple to the search space.
-            # This is used to index the stats at that point for the particular tuple in question
-            search_space_value = point[tup]
+        # One index per tuple and blocks never overlap, so every tuple is updated in one pass
+        indices = self._get_statistics_indices([point], is_allocating=True)[0]
+        self._counts[indices] += weight
+        self._sums[indices] += weight * fitness
+        self._sums_squared[indices] += weight * fitness ** 2
+        self._totals += weight
 
-            # Use 'totals' as a key to store summary data of the tuple
-            self._tuple_stats[tuple(tup)]['totals']['n'] += 1
+    def add_pending_point(self, point):
+        """
+        Count a point that is being evaluated as a visit in the exploration estimate, so concurrent proposals spread out
+        """
+        indices = self._get_statistics_indices([point], is_allocating=True)[0]
+        self._pending_counts[indices] += 1
+        self._pending_totals += 1
 
-            search_space_tuple_stats = self._tuple_stats[tuple(tup)][tuple(search_space_value)]
-            search_space_tuple_stats['n'] += 1
-            search_space_tuple_stats['max'] = np.maximum(search_space_tuple_stats['max'], fitness)
-            search_space_tuple_stats['min'] = np.minimum(search_space_tuple_stats['max'], fitness)
-            search_space_tuple_stats['sum'] += fitness
-            search_space_tuple_stats['sum_squared'] += fitness ** 2
+    def remove_pending_point(self, point):
+        self._pending_counts[self._get_statistics_indices([point])[0]] -= 1
+        self._pending_totals -= 1
 
     def get_mean_estimtate(self, point):
-        """
-        Iterate over all the tuple stats we have stored for this point and sum the means and the number
-        of stats we have found.
-
-        Finally the sum of the means divided by the total number of stats found is returned
-        """
-        sum = 0
-        tuple_count = 0
-        for tup in self._tuples:
-            search_space_value = point[tup]
-            tuple_stats = self._tuple_stats[tuple(tup)][tuple(search_space_value)]
-            if tuple_stats['n'] > 0:
-                sum += tuple_stats['sum'] / tuple_stats['n']
-                tuple_count += 1
-
-        if tuple_count == 0:
-            return 0
-        return sum / tuple_count
+        return self.get_mean_estimates([point])[0]
 
     def get_exploration_estimate(self, point):
+        return self.get_exploration_estimates([point])[0]
+
+    def get_mean_estimates(self, points):
         """
-        Calculate the average of the exploration across all tuples of the exploration
+        Average over the tuples of the mean fitness at each point's tuple values, tuples without samples are left out.
+        Points without any sampled tuple get 0
         """
-
-        sum = 0
-        tuple_count = len(self._tuples)
-
-        for tup in self._tuples:
-            search_space_value = point[tup]
-            tuple_stats = self._tuple_stats[tuple(tup)]
-            search_space_tuple_stats = tuple_stats[tuple(search_space_value)]
-            if search_space_tuple_stats['n'] == 0:
-                n = tuple_stats['totals']['n']
-                sum += np.sqrt(np.log(1 + n) / self._ucb_epsilon)
-            else:
-                n = search_space_tuple_stats['n']
-                sum += np.sqrt(np.log(1 + n) / (n + self._ucb_epsilon))
-
-        return sum / tuple_count
+        indices = self._get_statistics_indices(points)
+        counts = self._counts[indices]
+        is_sampled = counts > 0
+        means = np.divide(self._sums[indices], counts, out=np.zeros_like(counts), where=is_sampled)
+        tuple_counts = is_sampled.sum(axis=1)
+        return np.divide(means.sum(axis=1), tuple_counts, out=np.zeros(len(indices)), where=tuple_counts > 0)
+
+    def get_exploration_estimates(self, points):
+        """
+        Average over the tuples of the exploration term, pending evaluations count as visits
+        """
+        indices = self._get_statistics_indices(points)
+        counts = self._counts[indices] + self._pending_counts[indices]
+        totals = self._totals + self._pending_totals
+        unvisited = np.sqrt(np.log(1 + totals) / self._ucb_epsilon)
+        visited = np.sqrt(np.log(1 + counts) / (counts + self._ucb_epsilon))
+        return np.where(counts == 0, unvisited, visited).mean(axis=1)
 
     def get_best_sampled(self):
-        current_best_mean = 0
-        current_best_point = None
-        for point in self._sampled_points:
-            mean = self.get_mean_estimtate(np.array(point))
-
-            if mean > current_best_mean:
-                current_best_mean = mean
-                current_best_point = point
-
-        return current_best_point
+        if not self._sampled_points:
+            return None
+        points = list(self._sampled_points)
+        return points[int(np.argmax(self.get_mean_estimates(points)))]
 
     def get_data(self):
-        data = {'tuple_stats': self._tuple_stats,
+        data = {'counts': self._counts,
+                'sums': self._sums,
+                'sums_squared': self._sums_squared,
+                'totals': self._totals,
+                'offsets': self._offsets,
+                'sparse_slots': self._sparse_slots,
                 'tuple_config': self._tuple_config,
                 'tuples': self._tuples,
                 'ndims': self._ndims,
@@ -256,16 +322,37 @@ class NTupleLandscape(BanditLandscapeModel):
         return data
 
     def load_data(self, data):
-        self._tuple_stats = data['tuple_stats']
         self._tuple_config = data['tuple_config']
         self._tuples = data['tuples']
         self._ndims = data['ndims']
         self._sampled_points = data['sampled_points']
+        self.reset()
+        if 'tuple_stats' in data:  # Sessions saved before the dense statistics
+            self._load_tuple_stats(data['tuple_stats'])
+        else:
+            self._counts, self._sums, self._sums_squared, self._totals = data['counts'], data['sums'], data['sums_squared'], data['totals']
+            self._sparse_slots = data['sparse_slots']
+            self._pending_counts = np.zeros(self._counts.size)
+
+    def _load_tuple_stats(self, tuple_stats):
+        for tuple_index, tup in enumerate(self._tuples):
+            for search_space_value, stats in tuple_stats[tuple(tup)].items():
+                if search_space_value == 'totals':
+                    self._totals[tuple_index] = stats['n']
+                    continue
+                codes = [self._value_indices[dim][str(value)] for dim, value in zip(tup, search_space_value)]
+                index = self._offsets[tuple_index] + int(np.dot(codes, self._strides[tuple_index, tup]))
+                if self._sparse_slots[tuple_index] is not None:
+                    index = self._get_sparse_slot(tuple_index, index, is_allocating=True)
+                self._counts[index] = stats['n']
+                self._sums[index] = stats['sum']
+                self._sums_squared[index] = stats['sum_squared']
 
 class NTupleEvolutionaryAlgorithm():
 
     def __init__(self, tuple_landscape, evaluator, search_space, mutator, k_explore=100, n_samples=1,
-                 eval_neighbours=50, world_model=None, agent_type=None, config=None):
+                 eval_neighbours=50, world_model=None, agent_type=None, config=None, parallel_evaluations=1,
+                 is_exhaustive_neighbourhood=False):
         self._logger = logging.getLogger('NTupleEvolutionaryAlgorithm')
 
         self._tuple_landscape = tuple_landscape
@@ -276,6 +363,9 @@ class NTupleEvolutionaryAlgorithm():
         self._n_samples = n_samples
         self._eval_neighbours = min(eval_neighbours, search_space.get_size())
         self._tie_break_noise = 1e-6
+        self._parallel_evaluations = parallel_evaluations  # Concurrent evaluations in a process pool, 1 evaluates points one at a time
+        self._is_exhaustive_neighbourhood = is_exhaustive_neighbourhood
+        self._incumbent_lower_bound = None  # Best lower confidence bound of a fully raced point
 
         self._logger.info('Search Space: %s' % self._search_space.get_name())
         self._logger.info('Evaluator: %s' % self._evaluator.get_name())
@@ -291,35 +381,41 @@ class NTupleEvolutionaryAlgorithm():
 
         self._logger.debug('Estimating landscape around %s', point)
 
-        evaluated_neighbours = set()
-
-        unique_neighbours = 0
-        current_best_ucb = 0
-        current_best_neighbour = None
-
-        # Loop until we have the required numbers of estimated neighbours
-        while unique_neighbours < self._eval_neighbours:
+        # All neighbours are scored by UCB in one pass over the tuple statistics
+        neighbours = self._get_neighbours(point)
+        exploit = self._tuple_landscape.get_mean_estimates(neighbours)
+        explore = self._tuple_landscape.get_exploration_estimates(neighbours)
+        ucb_with_noise = exploit + self._k_explore * explore + np.random.uniform(size=len(neighbours)) * self._tie_break_noise
+
+        best_neighbour = int(np.argmax(ucb_with_noise))
+        self._logger.debug('Found best UCB %.2f at %s' % (ucb_with_noise[best_neighbour], neighbours[best_neighbour]))
+        print('Found best UCB %.2f at %s' % (ucb_with_noise[best_neighbour], neighbours[best_neighbour]))
+        return neighbours[best_neighbour]
+
+    def _get_neighbours(self, point):
+        # The exact 1-mutation neighbourhood replaces sampling when it fits within the neighbour budget
+        if self._is_exhaustive_neighbourhood and self._get_neighbourhood_size(point) <= self._eval_neighbours:
+            return self._get_one_mutation_neighbours(point)
+
+        # Loop until we have the required numbers of unique neighbours
+        neighbours = {}
+        while len(neighbours) < self._eval_neighbours:
             potential_neighbour = self._mutator.mutate(point)
-
-            # If we already have estimates for this unique neighbour then just get a new one
-            if tuple(potential_neighbour) in evaluated_neighbours:
-                continue
-
-            unique_neighbours += 1
-            exploit = self._tuple_landscape.get_mean_estimtate(potential_neighbour)
-            explore = self._tuple_landscape.get_exploration_estimate(potential_neighbour)
-            ucb_with_noise = exploit + self._k_explore * explore + np.random.uniform() * self._tie_break_noise
-            evaluated_neighbours.add(tuple(potential_neighbour))
-            self._logger.debug('Neighbour UCB %.2f at %s' % (ucb_with_noise, potential_neighbour))
-
-            # Track the best neighbour that we have seen so far
-            if current_best_ucb < ucb_with_noise:
-                self._logger.debug('Found best UCB %.2f at %s' % (ucb_with_noise, potential_neighbour))
-                print('Found best UCB %.2f at %s' % (ucb_with_noise, potential_neighbour))
-                current_best_ucb = ucb_with_noise
-                current_best_neighbour = copy.deepcopy(potential_neighbour)
-
-        return current_best_neighbour
+            neighbours.setdefault(tuple(potential_neighbour), potential_neighbour)
+        return list(neighbours.values())
+
+    def _get_neighbourhood_size(self, point):
+        return sum(len(self._search_space.get_valid_values_in_dim(dim)) - 1 for dim in range(len(point)))
+
+    def _get_one_mutation_neighbours(self, point):
+        neighbours = []
+        for dim in range(len(point)):
+            for value in self._search_space.get_valid_values_in_dim(dim):
+                if str(value) != str(point[dim]):
+                    neighbour = list(point)
+                    neighbour[dim] = value
+                    neighbours.append(np.array(neighbour))
+        return neighbours
 
     def run(self, n_evaluations):
         start_eval = 0
@@ -342,6 +438,9 @@ class NTupleEvolutionaryAlgorithm():
         progress_bar = tqdm(total=n_evaluations, desc="NTBEA Iteration",)
         progress_bar.set_postfix_str(f"Solution: {point}")
 
+        if self._parallel_evaluations > 1:
+            return self._run_async(start_eval, n_evaluations, point, best_solution, best_fitness, progress_bar)
+
         for eval in range(start_eval, n_evaluations):
             print(f'\n-- NTBEA Iteration: {eval} --\n')
             # Explore the neighbourhood in the tuple landscape and find a strong next candidate point
@@ -350,13 +449,14 @@ class NTupleEvolutionaryAlgorithm():
                 point = self._evaluate_landscape(point)
                 print(f'Current evaluated: {point}')
 
-            # Evaluate the point (is repeated several times if n_samples > 0)
-            fitness = self._evaluator.evaluate(point)
+            # Evaluate the point (is repeated several times if n_samples > 0), racing evaluators may stop early
+            fitness, evaluated_fraction, lower_bound = self._evaluator.race(point, self._incumbent_lower_bound)
+            self._update_incumbent(evaluated_fraction, lower_bound)
 
             self._logger.debug('Evaluated fitness: %.2f at %s' % (fitness, point))
 
             # Add the new point to the tuple landscape
-            self._tuple_landscape.add_evaluated_point(point, fitness)
+            self._tuple_landscape.add_evaluated_point(point, fitness, evaluated_fraction)
 
             # Set initial best fitness for tracking
             if best_solution is None:
@@ -380,11 +480,65 @@ class NTupleEvolutionaryAlgorithm():
         self._logger.info('Best solution: %s' % (best_solution,))
         return best_solution, best_fitness
 
+    def _run_async(self, start_eval, n_evaluations, point, best_solution, best_fitness, progress_bar):
+        """
+        Keeps parallel_evaluations points in flight. New points are proposed by UCB around the last proposal with in-flight
+        points counted as pending visits, and results are added to the landscape in completion order.
+        The session only ever holds completed evaluations, so a reloaded session simply proposes the in-flight points again.
+        """
+        pending = {}  # future -> (point, is_best_reevaluation)
+        proposed, completed = start_eval, start_eval
+        with ProcessPoolExecutor(max_workers=self._parallel_evaluations, mp_context=multiprocessing.get_context('spawn')) as executor:
+            while completed < n_evaluations or pending:
+                while len(pending) < self._parallel_evaluations and proposed < n_evaluations:
+                    if proposed > 0:
+                        point = self._evaluate_landscape(point)
+                    self._tuple_landscape.add_pending_point(point)
+                    pending[executor.submit(self._evaluator.race, point, self._incumbent_lower_bound)] = (point, False)
+                    proposed += 1
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    evaluated_point, is_best_reevaluation = pending.pop(future)
+                    if is_best_reevaluation:  # The best solution only changes with its fitness, so checkpoints keep a matching pair
+                        best_solution, best_fitness = evaluated_point, future.result()
+                        print('Iterations: %d, Best fitness: %s, Solution: %s' % (completed, best_fitness, best_solution))
+                        continue
+
+                    fitness, evaluated_fraction, lower_bound = future.result()
+                    self._update_incumbent(evaluated_fraction, lower_bound)
+                    self._tuple_landscape.remove_pending_point(evaluated_point)
+                    self._tuple_landscape.add_evaluated_point(evaluated_point, fitness, evaluated_fraction)
+                    self._logger.debug('Evaluated fitness: %.2f at %s' % (fitness, evaluated_point))
+                    if best_solution is None:
+                        best_solution, best_fitness = evaluated_point, fitness
+
+                    best_sampled = self._tuple_landscape.get_best_sampled() if completed % 10 == 0 and completed != 0 else None
+                    if best_sampled is not None:  # Best point is re-evaluated without blocking the search
+                        print(' --- Update and eval best point. ---')
+                        pending[executor.submit(self._evaluator.evaluate, best_sampled)] = (best_sampled, True)
+
+                    progress_bar.set_postfix_str(f"Fitness: {fitness}, Solution: {evaluated_point}")
+                    progress_bar.update(1)
+                    self._save_session(completed, best_fitness, best_solution)
+                    completed += 1
+
+        print('Retrieving best solution...')
+        self._save_session(n_evaluations, best_fitness, best_solution)
+        self._logger.info('Best solution: %s' % (best_solution,))
+        return best_solution, best_fitness
+
+    def _update_incumbent(self, evaluated_fraction, lower_bound):  # Only fully evaluated points can become the incumbent
+        if evaluated_fraction == 1 and lower_bound is not None and \
+                (self._incumbent_lower_bound is None or lower_bound > self._incumbent_lower_bound):
+            self._incumbent_lower_bound = lower_bound
+
     def _get_data(self):
         data = {
             'k_explore': self._k_explore,
             'n_samples': self._n_samples,
             'eval_neighbours': self._eval_neighbours,
+            'incumbent_lower_bound': self._incumbent_lower_bound
         }
         return data
 
@@ -392,6 +546,7 @@ class NTupleEvolutionaryAlgorithm():
         self._k_explore = data['k_explore']
         self._n_samples = data['n_samples']
         self._eval_neighbours = data['eval_neighbours']
+        self._incumbent_lower_bound = data.get('incumbent_lower_bound')
 
     def _save_session(self, eval, best_fitness, best_solution):
         session_filename = f'ntbea_session_{self._world_model}_{self._agent_type}'
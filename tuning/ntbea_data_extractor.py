@@ -28,6 +28,21 @@ def load_session(filename):
                    search_space, world_model, agent_type
     raise Exception('File not found')
 
+def get_one_tuple_stats(tuples, search_space):
+    if 'tuple_stats' in tuples:  # Sessions saved before the dense statistics
+        return [tuples['tuple_stats'][(dim,)] for dim in range(len(search_space))]
+
+    one_tuple_stats = []
+    for dim, values in enumerate(search_space):
+        tuple_index = tuples['tuples'].index([dim])
+        offset = tuples['offsets'][tuple_index]
+        one_tuple_stats.append({'totals': {'n': tuples['totals'][tuple_index]}, **{
+            (str(value),): {'n': tuples['counts'][offset + index], 'sum': tuples['sums'][offset + index],
+                            'sum_squared': tuples['sums_squared'][offset + index]}
+            for index, value in enumerate(values)}})
+    return one_tuple_stats
+
+
 def print_results(best_params_config, fitness, agent_type, world_model, iterations):
     print(f'COMPLETED {iterations} NTBEA Iterations for planning agent: {agent_type} with world model: {world_model}')
     stats = f'-- Best Configuration --' \
@@ -54,6 +69,5 @@ print_results(solution, fitness, agent_type, world_model, iterations)
 
 print(search_space)
 pp = pprint.PrettyPrinter(indent=0)
-one_tuple = [(i,) for i in range(len(search_space['search_space']))]
-one_tuple_stats = [tuples['tuple_stats'][key] for key in one_tuple]
+one_tuple_stats = get_one_tuple_stats(tuples, search_space['search_space'])
 pp.pprint(one_tuple_stats)
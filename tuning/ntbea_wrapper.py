@@ -51,12 +51,18 @@ class PlanningSearchSpace(SearchSpace, ABC):
 
 
 class PlanningEvaluator(Evaluator):
-    def __init__(self, planning_test_suite, agent_type):
+    def __init__(self, planning_test_suite, agent_type, is_racing=False, racing_trials_per_round=5, racing_z=1.96):
         super(PlanningEvaluator, self).__init__("Planning Evalutator")
         self.test_suite = planning_test_suite
         self.agent_type = agent_type
+        self.is_racing = is_racing
+        self.racing_trials_per_round = racing_trials_per_round
+        self.racing_z = racing_z  # Width of the confidence interval in standard errors
 
     def evaluate(self, point):
+        if self.is_racing:  # Same fitness as raced points: the mean trial reward summed over the tests
+            return self.race(point, None)[0]
+
         self._set_agent_params(point)
         self.test_suite.is_ntbea_tuning = True
         self.test_suite.is_logging = False
@@ -69,6 +75,36 @@ class PlanningEvaluator(Evaluator):
 
         return np.mean(rewards)
 
+    def race(self, point, incumbent_lower_bound):
+        """
+        Runs the test trials in rounds and abandons the point as soon as the upper confidence bound of its mean trial
+        reward falls below the lower bound of the incumbent
+        """
+        if not self.is_racing:
+            return super().race(point, incumbent_lower_bound)
+
+        self._set_agent_params(point)
+        self.test_suite.is_ntbea_tuning = True
+        self.test_suite.is_logging = False
+
+        max_trials = self.test_suite.trials
+        trial_rewards = []
+        while len(trial_rewards) < max_trials:
+            test_rewards = self.test_suite.run_test_trials(min(self.racing_trials_per_round, max_trials - len(trial_rewards)))
+            trial_rewards.extend(np.sum(list(test_rewards.values()), axis=0))
+            mean, half_width = self._get_confidence_interval(trial_rewards)
+            if incumbent_lower_bound is not None and len(trial_rewards) < max_trials and mean + half_width < incumbent_lower_bound:
+                print(f'Racing: abandoned {point} after {len(trial_rewards)}/{max_trials} trials - '
+                      f'upper bound {mean + half_width:.2f} < incumbent lower bound {incumbent_lower_bound:.2f}')
+                break
+
+        return mean, len(trial_rewards) / max_trials, mean - half_width
+
+    def _get_confidence_interval(self, trial_rewards):
+        if len(trial_rewards) < 2:
+            return np.mean(trial_rewards), np.inf
+        return np.mean(trial_rewards), self.racing_z * np.std(trial_rewards, ddof=1) / np.sqrt(len(trial_rewards))
+
     def _set_agent_params(self, point):
         evolution_handler = self.test_suite.planning_agent.evolution_handler
 
@@ -101,6 +137,11 @@ class PlanningNTBEAWrapper:
         self.explore_rate = self.config['ntbea_tuning']['explore_rate']
         self.eval_neighbours = self.config['ntbea_tuning']['eval_neighbours']
         self.iterations = self.config['ntbea_tuning']['iterations']
+        self.parallel_evaluations = self.config['ntbea_tuning']['parallel_evaluations']
+        self.is_exhaustive_neighbourhood = self.config['ntbea_tuning']['is_exhaustive_neighbourhood']
+        self.is_racing = self.config['ntbea_tuning']['is_racing']
+        self.racing_trials_per_round = self.config['ntbea_tuning']['racing_trials_per_round']
+        self.racing_z = self.config['ntbea_tuning']['racing_z']
         self.agent_type = self.config['planning']['planning_agent']
         self.world_model = self.config['experiment_name']
         self._logger = NTBEALogger(is_logging=True)
@@ -113,7 +154,9 @@ class PlanningNTBEAWrapper:
         # Search Space and evaluator
         parameter_space = self._get_parameters(self.agent_type)
         search_space = PlanningSearchSpace(parameter_space)
-        planning_evaluator = PlanningEvaluator(self.planning_tester, self.agent_type)
+        planning_evaluator = PlanningEvaluator(self.planning_tester, self.agent_type, self.is_racing, self.racing_trials_per_round, self.racing_z)
+        if self.parallel_evaluations > 1:  # Evaluator is pickled per evaluation, shared weights keep that cheap
+            self.planning_tester._share_models()
 
         # 1-tuple, 2-tuple and N-tuple
         tuple_config = [1, 2, search_space._number_of_parameter_types]
@@ -126,7 +169,8 @@ class PlanningNTBEAWrapper:
         evolutionary_algorithm = NTupleEvolutionaryAlgorithm(tuple_landscape, planning_evaluator, search_space, mutator, self.explore_rate,
                                                              eval_neighbours=self.eval_neighbours,
                                                              world_model=self.world_model, agent_type=self.agent_type,
-                                                             config=self.config)
+                                                             config=self.config, parallel_evaluations=self.parallel_evaluations,
+                                                             is_exhaustive_neighbourhood=self.is_exhaustive_neighbourhood)
 
         best_params_config, fitness = evolutionary_algorithm.run(self.iterations)
         results = self._get_best_results(best_params_config, fitness)
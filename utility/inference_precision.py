@@ -0,0 +1,92 @@
+""" Reduced precision and channels-last inference for the VAE and MDRNN """
+#  Copyright (c) 2020, - All Rights Reserved
+#  This file is part of the Evolutionary Planning on a Learned World Model thesis.
+#  Unauthorized copying of this file, via any medium is strictly prohibited without the consensus of the authors.
+#  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
+
+import os
+import copy
+import torch
+import numpy as np
+from utility.rollout_handling.rollout_store import RolloutStore
+
+
+def prepare_models_for_inference(config, vae, mdrnn, preprocessor):
+    inference_config = config['inference']
+    is_bfloat16 = inference_config['is_bfloat16'] and torch.backends.mkldnn.is_available()
+    is_channels_last = inference_config['is_channels_last'] and torch.backends.mkldnn.is_available()
+    if not is_bfloat16 and not is_channels_last:
+        return vae, mdrnn
+
+    held_out_rollout = load_held_out_rollout(config)
+    if held_out_rollout is None:
+        print('No held-out rollout found for the inference accuracy guard - keeping float32 models')
+        return vae, mdrnn
+
+    reference_vae, reference_mdrnn = copy.deepcopy(vae).eval(), copy.deepcopy(mdrnn).eval()
+    if is_channels_last:
+        vae = vae.to(memory_format=torch.channels_last)
+        vae.encoder.register_forward_pre_hook(_to_channels_last_pre_hook)
+    if is_bfloat16:  # Callers keep passing and receiving float32, the casts happen at the module boundaries
+        for model in [vae.encoder, vae.decoder, mdrnn]:
+            model.to(torch.bfloat16)
+            model.register_forward_pre_hook(_to_bfloat16_pre_hook)
+            model.register_forward_hook(_to_float32_hook)
+
+    latent_error, reward_error = _compare_predictions(reference_vae, reference_mdrnn, vae, mdrnn, preprocessor, *held_out_rollout)
+    print(f'Inference mode bfloat16: {is_bfloat16} | channels last: {is_channels_last} | '
+          f'latent error: {latent_error:.4f} | reward error: {reward_error:.4f}')
+    if latent_error > inference_config['max_latent_error'] or reward_error > inference_config['max_reward_error']:
+        print('Inference accuracy guard failed - falling back to float32 models')
+        return reference_vae, reference_mdrnn
+    return vae, mdrnn
+
+
+def _compare_predictions(reference_vae, reference_mdrnn, vae, mdrnn, preprocessor, observations, actions):
+    with torch.no_grad():
+        frames = preprocessor.preprocess_frames(observations)
+        actions = torch.as_tensor(actions, dtype=torch.float32).unsqueeze(1)  # (seq_len, 1, num_actions)
+        reference_latents, _ = reference_vae.encoder(frames)
+        latents, _ = vae.encoder(frames)
+        reference_means, _, _, reference_rewards, _, _ = reference_mdrnn(actions, reference_latents.unsqueeze(1))
+        means, _, _, rewards, _, _ = mdrnn(actions, reference_latents.unsqueeze(1))  # Same inputs so only the MDRNN error is measured
+        latent_error = max((latents - reference_latents).abs().mean().item(), (means - reference_means).abs().mean().item())
+        reward_error = (rewards - reference_rewards).abs().mean().item()
+    return latent_error, reward_error
+
+
+def load_held_out_rollout(config):  # Test rollouts are taken from the end of the data directory
+    data_dir = config['test_data_dir'] if config['is_use_specific_test_data'] else config['data_dir']
+    num_frames = config['inference']['held_out_frames']
+    if RolloutStore.is_rollout_store(data_dir):
+        store = RolloutStore(data_dir)
+        if not store.rollout_names:
+            return None
+        data = store.get_rollout(store.rollout_names[-1])
+        return np.array(data['observations'][:num_frames]), np.array(data['actions'][:num_frames])
+
+    files = [os.path.join(root, name) for root, dirs, files in os.walk(data_dir) for name in files if name.endswith('.npz')]
+    if not files:
+        return None
+    with np.load(files[-1]) as data:
+        return data['observations'][:num_frames], data['actions'][:num_frames]
+
+
+def _to_bfloat16_pre_hook(module, inputs):  # Module level hooks keep the models picklable for process pools
+    return _cast(inputs, torch.bfloat16)
+
+
+def _to_float32_hook(module, inputs, output):
+    return _cast(output, torch.float32)
+
+
+def _to_channels_last_pre_hook(module, inputs):
+    return tuple(x.contiguous(memory_format=torch.channels_last) if torch.is_tensor(x) and x.dim() == 4 else x for x in inputs)
+
+
+def _cast(value, dtype):
+    if torch.is_tensor(value):
+        return value.to(dtype) if value.is_floating_point() else value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_cast(element, dtype) for element in value)
+    return value
@@ -0,0 +1,136 @@
+""" Local inference server: one model process serves batched MDRNN steps and VAE encodings to many worker processes """
+#  Copyright (c) 2020, - All Rights Reserved
+#  This file is part of the Evolutionary Planning on a Learned World Model thesis.
+#  Unauthorized copying of this file, via any medium is strictly prohibited without the consensus of the authors.
+#  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
+
+import time
+import queue
+import torch
+from torch import multiprocessing
+from mdrnn.mdrnn import get_mdrnn_cell, forward_mdrnn_cell
+from mdrnn.mdrnn_quantization import get_planning_mdrnn
+
+MDRNN_REQUEST = 'mdrnn'
+ENCODE_REQUEST = 'encode'
+
+inference_client = None  # Set per worker process by init_inference_client
+
+
+class InferenceServer:  # Tensors sent over torch multiprocessing queues are moved to shared memory instead of being copied
+    def __init__(self, config, vae, mdrnn, num_clients):
+        server_config = config['inference_server']
+        self.max_batch_size = server_config['max_batch_size']
+        self.max_wait = server_config['max_wait_ms'] / 1000
+        self.num_threads = server_config['num_threads']
+        # The same model variant the simulated environments would step, int8 activations are scaled per served batch
+        self.vae, self.mdrnn = vae, get_planning_mdrnn(config, mdrnn)
+        self.is_mdrnn_cell = config['simulated_environment']['is_mdrnn_cell']
+        self.is_torchscript_mdrnn_cell = config['simulated_environment']['is_torchscript_mdrnn_cell']
+        context = multiprocessing.get_context('spawn')
+        self.request_queue = context.Queue()
+        self.response_queues = [context.Queue() for _ in range(num_clients)]
+        self.client_counter = context.Value('i', 0)
+        self.clients = [InferenceClient(client_id, self.request_queue, response_queue) for client_id, response_queue in enumerate(self.response_queues)]
+        self.process = context.Process(target=_serve, daemon=True,
+                                       args=(self.vae, self.mdrnn, self.is_mdrnn_cell, self.is_torchscript_mdrnn_cell, self.request_queue,
+                                             self.response_queues, self.max_batch_size, self.max_wait, self.num_threads))
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def stop(self):
+        self.request_queue.put(None)
+        self.process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def get_initializer(self):  # Pool / ProcessPoolExecutor initializer and initargs that give every worker its own client
+        self.client_counter.value = 0
+        return init_inference_client, (self.clients, self.client_counter)
+
+
+class InferenceClient:  # Blocking calls, each worker has at most one request in flight
+    def __init__(self, client_id, request_queue, response_queue):
+        self.client_id = client_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+
+    def forward_mdrnn(self, actions, latents, hidden_states):  # Same inputs and outputs as MDRNN.forward with a sequence length of 1
+        self.request_queue.put((self.client_id, MDRNN_REQUEST, (actions, latents, hidden_states[0], hidden_states[1])))
+        means, standard_deviations, log_mixture_weights, rewards, dones, next_hidden_state, next_cell_state = self.response_queue.get()
+        return means, standard_deviations, log_mixture_weights, rewards, dones, (next_hidden_state, next_cell_state)
+
+    def encode(self, frames):  # (batch_size, channels, height, width) -> z_mean, z_log_variance
+        self.request_queue.put((self.client_id, ENCODE_REQUEST, (frames,)))
+        return self.response_queue.get()
+
+
+def init_inference_client(clients, client_counter):
+    global inference_client
+    with client_counter.get_lock():
+        inference_client = clients[client_counter.value]
+        client_counter.value += 1
+
+
+def get_inference_client():
+    return inference_client
+
+
+def _serve(vae, mdrnn, is_mdrnn_cell, is_torchscript_mdrnn_cell, request_queue, response_queues, max_batch_size, max_wait, num_threads):
+    torch.set_num_threads(num_threads)
+    vae, mdrnn = vae.eval(), mdrnn.eval()
+    mdrnn_cell = get_mdrnn_cell(mdrnn, is_torchscript_mdrnn_cell) if is_mdrnn_cell else None  # Built here, scripted cells do not pickle
+    is_running = True
+    with torch.no_grad():
+        while is_running:
+            requests, is_running = _collect_requests(request_queue, max_batch_size, max_wait)
+            for request_type, forward, batch_dim in [(MDRNN_REQUEST, lambda *inputs: _forward_mdrnn(mdrnn, mdrnn_cell, *inputs), 1),
+                                                     (ENCODE_REQUEST, vae.encoder, 0)]:
+                batch = [(client_id, inputs) for client_id, kind, inputs in requests if kind == request_type]
+                if batch:
+                    _run_batch(batch, forward, batch_dim, response_queues)
+
+
+def _collect_requests(request_queue, max_batch_size, max_wait):  # Dynamic batching: wait for one request, then up to max_wait for more
+    request = request_queue.get()
+    if request is None:
+        return [], False
+    requests, batch_size = [request], _get_batch_size(request)
+    deadline = time.perf_counter() + max_wait
+    while batch_size < max_batch_size:
+        try:
+            request = request_queue.get(timeout=max(deadline - time.perf_counter(), 0))
+        except queue.Empty:
+            break
+        if request is None:
+            return requests, False
+        requests.append(request)
+        batch_size += _get_batch_size(request)
+    return requests, True
+
+
+def _get_batch_size(request):
+    _, kind, inputs = request
+    return inputs[0].size(1) if kind == MDRNN_REQUEST else inputs[0].size(0)
+
+
+def _forward_mdrnn(mdrnn, mdrnn_cell, actions, latents, hidden_state, cell_state):
+    means, standard_deviations, log_mixture_weights, rewards, dones, (next_hidden_state, next_cell_state) = \
+        mdrnn(actions, latents, (hidden_state, cell_state)) if mdrnn_cell is None else \
+        forward_mdrnn_cell(mdrnn_cell, actions, latents, (hidden_state, cell_state))
+    return means, standard_deviations, log_mixture_weights, rewards, dones, next_hidden_state, next_cell_state
+
+
+def _run_batch(batch, forward, batch_dim, response_queues):
+    client_ids, inputs = zip(*batch)
+    split_sizes = [client_inputs[0].size(batch_dim) for client_inputs in inputs]
+    outputs = forward(*[torch.cat(tensors, dim=batch_dim) for tensors in zip(*inputs)])
+    client_outputs = zip(*[output.split(split_sizes, dim=batch_dim) for output in outputs])
+    for client_id, output in zip(client_ids, client_outputs):
+        response_queues[client_id].put(tuple(tensor.clone() for tensor in output))  # Clone so each client only maps its own rows
@@ -5,10 +5,13 @@
 #  Written by Thor V.A.N. Olesen <thorolesen@gmail.com> & Dennis T.T. Nguyen <dennisnguyen3000@yahoo.dk>.
 
 import torch
+import inspect
 import numpy as np
 import torch.nn.functional as F
 from torchvision import transforms
 
+IS_ANTIALIAS_SUPPORTED = 'antialias' in inspect.signature(F.interpolate).parameters  # torch >= 1.11
+
 
 class Preprocessor:
     def __init__(self, config):
@@ -17,22 +20,33 @@ class Preprocessor:
         self.img_width = self.config['img_width']
 
     def normalize_frames_train(self, frame): # Windows does not support pickle of lambda funcs
-        normalize_transforms = [transforms.ToPILImage(), transforms.RandomHorizontalFlip(), transforms.ToTensor()]
-        transpose_function = transforms.Compose(normalize_transforms)
-        return transpose_function(frame)
+        return self.preprocess_frames(frame[None], is_flip=True, is_resize=False)[0]  # Same as ToPILImage, RandomHorizontalFlip, ToTensor
 
     def normalize_frames_test(self, frame):  # Windows does not support pickle of lambda funcs
-        normalize_transforms = [transforms.ToPILImage(), transforms.ToTensor()]
-        transpose_function = transforms.Compose(normalize_transforms)
-        return transpose_function(frame)
+        return self.preprocess_frames(frame[None], is_resize=False)[0]
 
     def resize_frame(self, frame):
-        transform = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.Resize((self.img_height, self.img_width)),
-            transforms.ToTensor()
-        ])
-        return transform(frame)
+        return self.preprocess_frame(frame)[0]
+
+    def preprocess_frame(self, frame):  # Single frame fast path: uint8 (H, W, C) -> float (1, C, img_height, img_width)
+        return self.preprocess_frames(frame[None])
+
+    def preprocess_frames(self, frames, is_flip=False, is_resize=True, device=None):
+        # Tensor-native batch pipeline: uint8 (B, H, W, C) -> float (B, C, img_height, img_width) in [0, 1]
+        frames = frames if type(frames) == torch.Tensor else torch.tensor(np.asarray(frames))
+        frames = frames.to(device) if device is not None else frames  # uint8 is cheaper to move than float
+        frames = frames.permute(0, 3, 1, 2).float().div(255)  # div copies, .float() of a float tensor does not
+        if is_resize and frames.shape[-2:] != (self.img_height, self.img_width):
+            frames = self._resize(frames)
+        if is_flip:  # Horizontal flip of each frame with probability 0.5
+            flip_mask = torch.rand(frames.size(0), device=frames.device) < 0.5
+            frames[flip_mask] = frames[flip_mask].flip(-1)
+        return frames.contiguous()
+
+    def _resize(self, frames):  # Area averaging stands in for antialiased bilinear on older torch versions
+        if IS_ANTIALIAS_SUPPORTED:
+            return F.interpolate(frames, size=(self.img_height, self.img_width), mode='bilinear', align_corners=False, antialias=True)
+        return F.interpolate(frames, size=(self.img_height, self.img_width), mode='area')
 
     def downsample_normalize_frames(self, frames):
         # 0=batch size, 3=img channels, 1 and 2 = img dims, / 255 normalize
@@ -0,0 +1,70 @@
+""" Encodes rollouts once with a frozen VAE so MDRNN training can read latents instead of frames """
+
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn.functional as f
+from os.path import join, exists, relpath, dirname
+from utility.rollout_handling.rollout_store import RolloutStore, INDEX_FILENAME
+
+
+def get_latent_data_dir(vae, config, data_dir):  # Latents are only valid for the VAE they were encoded with
+    return f'{data_dir.rstrip(os.sep)}_latents_{config["experiment_name"]}_{get_vae_fingerprint(vae)}'
+
+
+def get_vae_fingerprint(vae):
+    digest = hashlib.sha1()
+    for name, tensor in vae.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+
+def encode_rollouts(vae, transform, config, data_dir, device, batch_size=250):  # Only rollouts without valid stored latents are encoded
+    latent_data_dir = get_latent_data_dir(vae, config, data_dir)
+    store = RolloutStore(data_dir) if RolloutStore.is_rollout_store(data_dir) else None
+    files = store.rollout_names if store else sorted(join(root, name) for root, dirs, files in os.walk(data_dir) for name in files)
+    for file in files:
+        latent_file = join(latent_data_dir, file if store else relpath(file, data_dir))
+        source_stamp = _get_source_stamp(store, data_dir, file)
+        if _is_latent_valid(latent_file, source_stamp):
+            continue
+        os.makedirs(dirname(latent_file), exist_ok=True)
+        data = store.get_rollout(file) if store else _load_rollout(file)
+        mu, logsigma = encode_observations(vae, transform, config, data['observations'], device, batch_size)
+        np.savez_compressed(latent_file, mu=mu.astype(np.float16), logsigma=logsigma.astype(np.float16),
+                            actions=data['actions'], rewards=data['rewards'], terminals=data['terminals'], source_stamp=source_stamp)
+    print(f'Encoded latents of {len(files)} rollouts in {latent_data_dir}')
+    return latent_data_dir
+
+
+def _get_source_stamp(store, data_dir, file):  # Iterative training overwrites rollout files in place once its buffer wraps
+    source_stat = os.stat(join(data_dir, INDEX_FILENAME) if store else file)
+    return np.array([source_stat.st_size, source_stat.st_mtime_ns], dtype=np.int64)
+
+
+def _is_latent_valid(latent_file, source_stamp):
+    if not exists(latent_file):
+        return False
+    with np.load(latent_file) as data:
+        return 'source_stamp' in data.files and np.array_equal(data['source_stamp'], source_stamp)
+
+
+def _load_rollout(file):
+    with np.load(file) as data:
+        return {k: np.copy(v) for k, v in data.items()}
+
+
+def encode_observations(vae, transform, config, observations, device, batch_size=250):
+    image_height, image_width = config['preprocessor']['img_height'], config['preprocessor']['img_width']
+    mus, logsigmas = [], []
+    with torch.no_grad():
+        for i in range(0, len(observations), batch_size):  # Same frame pipeline as MDRNNTrainer._to_latent
+            frames = torch.from_numpy(np.ascontiguousarray(transform(observations[i:i + batch_size].astype(np.float32)))).to(device)
+            frames = f.interpolate(frames.view(-1, config['preprocessor']['num_channels'], image_height, image_width),
+                                   size=config['latent_size'], mode='bilinear', align_corners=True)
+            mu, logsigma = vae.encoder(frames)
+            mus.append(mu.cpu().numpy())
+            logsigmas.append(logsigma.cpu().numpy())
+    return np.concatenate(mus), np.concatenate(logsigmas)
@@ -4,6 +4,8 @@ import os
 import random
 import numpy as np
 import torch.utils.data
+from collections import OrderedDict
+from utility.rollout_handling.rollout_store import RolloutStore
 
 # Original code by Ctallec: https://github.com/ctallec/world-models/blob/master/data/loaders.py
 class _MDRNNRolloutDataset(torch.utils.data.Dataset):
@@ -12,7 +14,8 @@ class _MDRNNRolloutDataset(torch.utils.data.Dataset):
     def __init__(self, root, transform, buffer_size=100, is_train=True, is_same_testdata=False, file_ratio=0.5, max_size=0, is_random_sampling=False):
         self.is_same_testdata = is_same_testdata
         self._transform = transform
-        self._files = [os.path.join(root, name) for root, dirs, files in os.walk(root) for name in files]
+        self._store = RolloutStore(root) if RolloutStore.is_rollout_store(root) else None  # root converted by rollout_store
+        self._files = self._store.rollout_names if self._store else sorted(os.path.join(root, name) for root, dirs, files in os.walk(root) for name in files)
 
         if is_same_testdata and len(_MDRNNRolloutDataset.CURRENT_TESTDATA):
             self._take_last_as_test(self._files, max_size, file_ratio) # TODO Since we use HA data for initial tests we want to always use same tests here and never random rollouts in ha
@@ -77,9 +80,13 @@ class _MDRNNRolloutDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, i):
         # print(f'loaded: {self._files[i]}')
-        with np.load(self._files[i]) as data:
-            data = {k: np.copy(v) for k, v in data.items()}
-        return self._get_data(data)
+        return self._get_data(self._load_rollout(self._files[i]))
+
+    def _load_rollout(self, file):
+        if self._store:
+            return self._store.get_rollout(file)  # Zero copy memmap views, sliced to windows by _get_data
+        with np.load(file) as data:
+            return {k: np.copy(v) for k, v in data.items()}
 
     def _get_data(self, data):
         pass
@@ -113,24 +120,101 @@ class RolloutSequenceDataset(_MDRNNRolloutDataset):
     :args train: if True, train data_random_car, else test
     """
     def __init__(self, root, seq_len, transform, buffer_size=100, is_train=True, is_same_testdata=False, file_ratio=0.5,
-                       max_size=0, is_random_sampling=False):
+                       max_size=0, is_random_sampling=False, is_precomputed_latents=False, window_stride=0):
         super().__init__(root, transform, buffer_size, is_train, is_same_testdata, file_ratio, max_size, is_random_sampling)
         self._seq_len = seq_len
+        self._is_precomputed_latents = is_precomputed_latents  # root holds mu/logsigma files from latent_encoder instead of frames
+        self._is_train = is_train
 
-    def _get_data(self, data):
-        obs_data = data['observations'][:self._seq_len + 1] if self._seq_len else data['observations'][:]
+        # Windowed sampling: every (file, start offset) window with the given stride instead of one sequence per file
+        self._window_stride = window_stride
+        self._windows = self._get_windows() if window_stride > 0 and seq_len else None
+        self._rollout_cache = OrderedDict()  # Last buffer_size loaded npz rollouts, memmapped stores need no cache
+
+    def __len__(self):
+        return len(self._files) if self._windows is None else len(self._windows)
+
+    def __getitem__(self, i):
+        if self._windows is None:
+            return super().__getitem__(i)
+        file_index, start, num_starts = self._windows[i]
+        if self._is_train:  # Random start within the stride so all offsets are covered across epochs
+            start += random.randrange(min(self._window_stride, num_starts - start))
+        return self._get_data(self._load_cached_rollout(self._files[file_index]), start)
+
+    def get_window_sampler(self):  # Npz windows are grouped by file so the rollout cache hits, memmapped stores shuffle freely
+        return None if self._windows is None or self._store else FileGroupedWindowSampler(self._windows, self._buffer_size)
+
+    def _get_windows(self):
+        windows = []
+        for file_index, file in enumerate(self._files):
+            num_starts = self._data_per_sequence(self._get_rollout_length(file))
+            windows += [(file_index, start, num_starts) for start in range(0, num_starts, self._window_stride)]
+        return windows
+
+    def _get_rollout_length(self, file):
+        if self._store:
+            return self._store.rollouts[file]['length']
+        with np.load(file) as data:
+            return data['rewards'].shape[0]  # Only decompresses the small rewards array
+
+    def _load_cached_rollout(self, file):
+        if self._store:
+            return self._load_rollout(file)
+        if file in self._rollout_cache:
+            self._rollout_cache.move_to_end(file)
+        else:
+            self._rollout_cache[file] = self._load_rollout(file)
+            if len(self._rollout_cache) > self._buffer_size:
+                self._rollout_cache.popitem(last=False)
+        return self._rollout_cache[file]
+
+    def _get_data(self, data, start=0):
+        end = start + self._seq_len if self._seq_len else None
+        if self._is_precomputed_latents:
+            return self._get_latent_data(data, start, end)
+        obs_data = data['observations'][start:end + 1] if self._seq_len else data['observations'][:]
         obs_data = self._transform(obs_data.astype(np.float32))
         obs, next_obs = obs_data[:-1], obs_data[1:]
-        action = data['actions'][:self._seq_len] if self._seq_len else data['actions'][:]
+        action = data['actions'][start:end]
         action = action.astype(np.float32)
-        reward, terminal = [data[key][:self._seq_len].astype(np.float32) for key in ('rewards', 'terminals')] if self._seq_len else \
-                           [data[key][:].astype(np.float32) for key in ('rewards', 'terminals')]
+        reward, terminal = [data[key][start:end].astype(np.float32) for key in ('rewards', 'terminals')]
 
         return obs, action, reward, terminal, next_obs  # data_random_car format
 
+    def _get_latent_data(self, data, start=0, end=None):  # Reparameterized latents sampled on the fly, obs and next_obs share one encoding
+        mu, logsigma = [torch.from_numpy(data[key][start:end + 1].astype(np.float32)) if self._seq_len else
+                        torch.from_numpy(data[key][:].astype(np.float32)) for key in ('mu', 'logsigma')]
+        latents = mu + logsigma.exp() * torch.randn_like(mu)
+        latent_obs, latent_next_obs = latents[:-1], latents[1:]
+        action = data['actions'][start:end]
+        action = action.astype(np.float32)
+        reward, terminal = [data[key][start:end].astype(np.float32) for key in ('rewards', 'terminals')]
+
+        return latent_obs, action, reward, terminal, latent_next_obs
+
     def _data_per_sequence(self, data_length):
         if data_length < self._seq_len:
             raise Exception(f'Sequence length in data is {data_length} which less than stated sequence length of {self._seq_len}')
         return data_length - self._seq_len
 
 
+class FileGroupedWindowSampler(torch.utils.data.Sampler):  # Shuffles the files, then the windows within each group of buffer_size files
+    def __init__(self, windows, buffer_size):
+        self._file_windows = OrderedDict()  # file index -> indices of its windows
+        for window_index, (file_index, _, _) in enumerate(windows):
+            self._file_windows.setdefault(file_index, []).append(window_index)
+        self._buffer_size = buffer_size
+        self._num_windows = len(windows)
+
+    def __iter__(self):
+        file_indices = list(self._file_windows)
+        random.shuffle(file_indices)
+        for group_start in range(0, len(file_indices), self._buffer_size):
+            group = [window_index for file_index in file_indices[group_start:group_start + self._buffer_size]
+                     for window_index in self._file_windows[file_index]]
+            random.shuffle(group)
+            yield from group
+
+    def __len__(self):
+        return self._num_windows
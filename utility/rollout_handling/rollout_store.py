@@ -0,0 +1,88 @@
+""" Memory-mapped rollout store: uncompressed uint8 observation shards and an index of rollout offsets """
+
+import os
+import sys
+import json
+import numpy as np
+from tqdm import tqdm
+from os.path import join, exists, relpath
+
+INDEX_FILENAME = 'index.json'
+
+
+class RolloutStore:  # Rollouts are looked up by name and returned as zero copy memmap views
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(join(store_dir, INDEX_FILENAME)) as index_file:
+            index = json.load(index_file)
+        self.observation_shape = tuple(index['observation_shape'])
+        self.shards = index['shards']
+        self.rollouts = {rollout['name']: rollout for rollout in index['rollouts']}
+        self.rollout_names = [rollout['name'] for rollout in index['rollouts']]
+        self._shard_arrays = {}  # Opened lazily per process
+
+    @staticmethod
+    def is_rollout_store(root):
+        return exists(join(root, INDEX_FILENAME))
+
+    def get_rollout(self, name):
+        rollout = self.rollouts[name]
+        shard = self._get_shard_arrays(rollout['shard'])
+        start, end = rollout['offset'], rollout['offset'] + rollout['length']
+        return {key: array[start:end] for key, array in shard.items()}
+
+    def _get_shard_arrays(self, shard_index):
+        if shard_index not in self._shard_arrays:
+            shard = self.shards[shard_index]
+            self._shard_arrays[shard_index] = {
+                'observations': np.memmap(join(self.store_dir, shard['observations']), dtype=np.uint8, mode='r',
+                                          shape=(shard['num_frames'], *self.observation_shape)),
+                **{key: np.load(join(self.store_dir, shard[key]), mmap_mode='r') for key in ('actions', 'rewards', 'terminals')}
+            }
+        return self._shard_arrays[shard_index]
+
+    def __getstate__(self):  # Memmaps are reopened in DataLoader workers instead of being pickled as arrays
+        state = self.__dict__.copy()
+        state['_shard_arrays'] = {}
+        return state
+
+
+def get_rollout_store_dir(data_dir):
+    return f'{data_dir.rstrip(os.sep)}_store'
+
+
+def convert_to_rollout_store(data_dir, store_dir=None, rollouts_per_shard=100):
+    store_dir = get_rollout_store_dir(data_dir) if store_dir is None else store_dir
+    files = sorted(join(root, name) for root, dirs, files in os.walk(data_dir) for name in files)  # Same order as the dataset file listing
+    if not files:
+        raise Exception(f'No rollouts found in {data_dir} to convert')
+    os.makedirs(store_dir, exist_ok=True)
+    index = {'observation_shape': None, 'shards': [], 'rollouts': []}
+
+    progress_bar = tqdm(total=len(files), desc=f'Converting rollouts to {store_dir}')
+    for shard_index, shard_start in enumerate(range(0, len(files), rollouts_per_shard)):
+        shard = {key: f'{key}_{shard_index}.{"u8" if key == "observations" else "npy"}' for key in ('observations', 'actions', 'rewards', 'terminals')}
+        num_frames, shard_data = 0, {'actions': [], 'rewards': [], 'terminals': []}
+        with open(join(store_dir, shard['observations']), 'wb') as observations_file:
+            for file in files[shard_start:shard_start + rollouts_per_shard]:
+                with np.load(file) as data:
+                    observations = np.ascontiguousarray(data['observations'], dtype=np.uint8)
+                    for key in shard_data:
+                        shard_data[key].append(data[key])
+                index['observation_shape'] = list(observations.shape[1:])
+                observations_file.write(observations.tobytes())
+                index['rollouts'].append({'name': relpath(file, data_dir), 'shard': shard_index, 'offset': num_frames, 'length': len(observations)})
+                num_frames += len(observations)
+                progress_bar.update(1)
+        for key, arrays in shard_data.items():
+            np.save(join(store_dir, shard[key]), np.concatenate(arrays))
+        index['shards'].append({**shard, 'num_frames': num_frames})
+    progress_bar.close()
+
+    with open(join(store_dir, INDEX_FILENAME), 'w') as index_file:  # Written last so a partial conversion is never picked up
+        json.dump(index, index_file)
+    return store_dir
+
+
+if __name__ == '__main__':  # python -m utility.rollout_handling.rollout_store <data_dir> [<store_dir>]
+    convert_to_rollout_store(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
@@ -1,19 +1,23 @@
 """ Some data loading utilities """
 import os
 from bisect import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os import listdir
 from os.path import join, isdir
 from tqdm import tqdm
 import torch.utils.data
 import numpy as np
+from utility.rollout_handling.rollout_store import RolloutStore
 
 class _VAERolloutDataset(torch.utils.data.Dataset): # pylint: disable=too-few-public-methods
     CURRENT_TESTDATA = set()
 
-    def __init__(self, root, transform, buffer_size=100, is_train=True, file_ratio=0.8): # pylint: disable=too-many-arguments
+    def __init__(self, root, transform, buffer_size=100, is_train=True, file_ratio=0.8, prefetch_depth=0): # pylint: disable=too-many-arguments
         self._transform = transform
 
-        self._files = [os.path.join(root, name) for root, dirs, files in os.walk(root) for name in files]
+        self._store = RolloutStore(root) if RolloutStore.is_rollout_store(root) else None  # root converted by rollout_store
+        self._files = self._store.rollout_names if self._store else sorted(os.path.join(root, name) for root, dirs, files in os.walk(root) for name in files)
         self._files = self._standard_sampling(self._files, is_train, file_ratio)
 
         self._cum_size = None
@@ -22,6 +26,11 @@ class _VAERolloutDataset(torch.utils.data.Dataset): # pylint: disable=too-few-pu
         self._buffer_index = 0
         self._buffer_size = buffer_size
 
+        # Double buffering: up to prefetch_depth next buffers are loaded by a background thread while training
+        self._prefetch_depth = prefetch_depth
+        self._prefetch_executor = None
+        self._prefetched_buffers = deque()
+
     def _standard_sampling(self, files, is_train, file_ratio):
         train_ratio, test_ratio = self._calc_file_ratio(len(files), file_ratio)
         return files[:train_ratio] if is_train else files[-test_ratio:]
@@ -33,24 +42,54 @@ class _VAERolloutDataset(torch.utils.data.Dataset): # pylint: disable=too-few-pu
 
     def load_next_buffer(self):
         """ Loads next buffer """
-        self._buffer_fnames = self._files[self._buffer_index:self._buffer_index + self._buffer_size]
+        if self._cum_size and len(self._files) <= self._buffer_size:
+            return  # Everything fits in the current buffer
+        if self._prefetch_depth <= 0:
+            self._buffer_fnames, self._buffer, self._cum_size = self._load_buffer(self._next_buffer_fnames(), is_progress_bar=True)
+            return
+
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        while len(self._prefetched_buffers) < self._prefetch_depth:
+            self._prefetched_buffers.append(self._prefetch_executor.submit(self._load_buffer, self._next_buffer_fnames()))
+        self._buffer_fnames, self._buffer, self._cum_size = self._prefetched_buffers.popleft().result()
+        self._prefetched_buffers.append(self._prefetch_executor.submit(self._load_buffer, self._next_buffer_fnames()))
+
+    def _next_buffer_fnames(self):
+        buffer_fnames = self._files[self._buffer_index:self._buffer_index + self._buffer_size]
         self._buffer_index += self._buffer_size
         self._buffer_index = self._buffer_index % len(self._files)
-        self._buffer = []
-        self._cum_size = [0]
+        return buffer_fnames
+
+    def _load_buffer(self, buffer_fnames, is_progress_bar=False):
+        buffer = []
+        cum_size = [0]
 
         # progress bar
-        pbar = tqdm(total=len(self._buffer_fnames),
-                    bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} {postfix}')
+        pbar = tqdm(total=len(buffer_fnames),
+                    bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} {postfix}', disable=not is_progress_bar)
         pbar.set_description("Loading file buffer ...")
 
-        for f in self._buffer_fnames:
-            with np.load(f) as data:
-                self._buffer += [{k: np.copy(v) for k, v in data.items()}]
-                self._cum_size += [self._cum_size[-1] +
-                                   self._data_per_sequence(data['rewards'].shape[0])]
+        for f in buffer_fnames:
+            data = self._load_rollout(f)
+            buffer += [data]
+            cum_size += [cum_size[-1] +
+                         self._data_per_sequence(data['rewards'].shape[0])]
             pbar.update(1)
         pbar.close()
+        return buffer_fnames, buffer, cum_size
+
+    def __getstate__(self):  # DataLoader workers only need the current buffer
+        state = self.__dict__.copy()
+        state['_prefetch_executor'] = None
+        state['_prefetched_buffers'] = deque()
+        return state
+
+    def _load_rollout(self, file):
+        if self._store:
+            return self._store.get_rollout(file)  # Zero copy memmap views
+        with np.load(file) as data:
+            return {k: np.copy(v) for k, v in data.items()}
 
     def __len__(self):
         # to have a full sequence, you need self.seq_len + 1 elements, as
@@ -36,6 +36,7 @@ class VaeTrainer:
         self.batch_size = self.config['vae_trainer']['batch_size']
         self.train_buffer_size = self.config['vae_trainer']['train_buffer_size']
         self.test_buffer_size = self.config['vae_trainer']['test_buffer_size']
+        self.prefetch_depth = self.config['vae_trainer']['prefetch_depth']
 
         if not exists(self.model_dir):
             mkdir(self.model_dir)
@@ -51,7 +52,8 @@ class VaeTrainer:
         self.optimizer = None
 
     def load_data(self):  # To avoid reloading in constructor when not training
-        self.train_dataset = RolloutObservationDataset(self.data_dir, self.preprocessor.normalize_frames_train, buffer_size=self.train_buffer_size)
+        self.train_dataset = RolloutObservationDataset(self.data_dir, self.preprocessor.normalize_frames_train, buffer_size=self.train_buffer_size,
+                                                       prefetch_depth=self.prefetch_depth)
         self.test_dataset = RolloutObservationDataset(self.data_dir, self.preprocessor.normalize_frames_test, buffer_size=self.test_buffer_size, is_train=False)
         self.train_loader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
         self.test_loader = DataLoader(self.test_dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
@@ -126,6 +128,7 @@ class VaeTrainer:
 
     def _train_epoch(self, epoch):
         self.vae.train()  # Turn on train mode
+        self.train_dataset.load_next_buffer()  # Swaps in the prefetched buffer when the data does not fit in one
         train_loss = 0
         progress_bar = tqdm(total=len(self.train_loader.dataset), desc=f"Train Epoch {epoch}")
         last_target_batch, last_predicted_batch = None, None